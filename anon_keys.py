@@ -0,0 +1,141 @@
+"""
+MRN -> AnonID key registry.
+
+Loads a key CSV once, assigns new AnonIDs (A1, A2, ...) to unseen MRNs in one vectorised
+batch, continuing after the highest existing number, and maps whole columns of MRNs
+to AnonIDs with a single indexed lookup. Existing assignments are never changed, so a
+top-up cohort reuses the keys of earlier projects and only extends them. Saving to the
+file the keys were loaded from appends the new rows instead of rewriting the file.
+
+Key CSVs have `mrn` and `AnonID` columns; files written by older versions of
+`create_simple_keys.py` (`PatientID`, `AnonID`) are read as well.
+"""
+
+import os
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+def read_keys(key_path: str) -> pd.DataFrame:
+    """
+    Reads a key CSV into a DataFrame with `mrn` and `AnonID` string columns.
+
+    Raises:
+        ValueError: If the file lacks the columns, or an MRN or AnonID appears twice.
+    """
+    keys = pd.read_csv(key_path, dtype=str, keep_default_na=False).rename(columns={'PatientID': 'mrn'})
+    if not {'mrn', 'AnonID'} <= set(keys.columns):
+        raise ValueError(f"Key file {key_path} needs 'mrn' and 'AnonID' columns, found {list(keys.columns)}")
+    keys = keys[['mrn', 'AnonID']].apply(lambda column: column.str.strip())
+    keys = keys[keys['mrn'] != '']
+    for column in ('mrn', 'AnonID'):
+        duplicated = keys.loc[keys[column].duplicated(), column]
+        if not duplicated.empty:
+            raise ValueError(f"Key file {key_path} has duplicate {column} values, e.g. {duplicated.iloc[0]}")
+    return keys.reset_index(drop=True)
+
+
+def _has_key_columns_only(key_path: str) -> bool:
+    """Checks that a key CSV has exactly the columns (mrn or PatientID, AnonID), so rows can be appended."""
+    if not os.path.exists(key_path):
+        return False
+    with open(key_path, newline='') as f:
+        header = [column.strip() for column in f.readline().split(',')]
+    return header in (['mrn', 'AnonID'], ['PatientID', 'AnonID'])
+
+
+class KeyRegistry:
+    """
+    MRN -> AnonID keys, loaded once and extended in batches.
+
+    Args:
+        key_path (str): Key CSV to load (if it exists) and to save to by default.
+        prefix (str): Prefix of new AnonIDs, followed by a number.
+    """
+
+    def __init__(self, key_path: str = None, prefix: str = 'A'):
+        self.key_path = key_path
+        self.prefix = prefix
+        if key_path and os.path.exists(key_path):
+            keys = read_keys(key_path)
+        else:
+            keys = pd.DataFrame({'mrn': pd.Series(dtype=str), 'AnonID': pd.Series(dtype=str)})
+        self._keys = pd.Series(keys['AnonID'].values, index=pd.Index(keys['mrn'].values, name='mrn'), name='AnonID')
+        self._n_saved = len(self._keys) if key_path and os.path.exists(key_path) else 0
+        self._valid_mrns = None
+
+        # New IDs continue after the highest existing number with this prefix
+        numbers = self._keys.str.extract(f'^{prefix}(\\d+)$', expand=False).dropna()
+        self._next_number = int(numbers.astype('int64').max()) + 1 if not numbers.empty else 1
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def keys(self) -> pd.DataFrame:
+        """All keys as a DataFrame with `mrn` and `AnonID` columns, in assignment order."""
+        return self._keys.reset_index()
+
+    @property
+    def valid_mrns(self) -> frozenset:
+        """Set of all MRNs with a key, for `dicom_io.match_mrn` (built once per batch of additions)."""
+        if self._valid_mrns is None:
+            self._valid_mrns = frozenset(self._keys.index.to_numpy())
+        return self._valid_mrns
+
+    def add(self, mrns: Iterable) -> pd.DataFrame:
+        """
+        Assigns AnonIDs to the MRNs that do not have one yet, in order of first appearance.
+
+        Args:
+            mrns: MRNs (list, Series...); empty values and 'NA' are ignored.
+
+        Returns:
+            pd.DataFrame: The new keys (`mrn`, `AnonID`).
+        """
+        if not isinstance(mrns, pd.Series):
+            mrns = pd.Series(list(mrns), dtype=object)
+        mrns = mrns.dropna().astype(str).str.strip()
+        mrns = mrns[(mrns != '') & (mrns != 'NA')].drop_duplicates()
+        # Hash lookup into the key index (its hash table is kept between lookups), rather than Series.isin
+        new = mrns[self._keys.index.get_indexer(mrns) == -1]
+        numbers = pd.Series(np.arange(self._next_number, self._next_number + len(new)), dtype='int64')
+        new_keys = pd.Series((self.prefix + numbers.astype(str)).values,
+                             index=pd.Index(new.values, name='mrn'), name='AnonID')
+        if len(new_keys):
+            self._keys = pd.concat([self._keys, new_keys])
+            self._next_number += len(new_keys)
+            self._valid_mrns = None
+        return new_keys.reset_index()
+
+    def map(self, mrns: pd.Series) -> pd.Series:
+        """Maps a column of MRNs to AnonIDs in one indexed lookup (NaN where an MRN has no key)."""
+        return mrns.astype(str).map(self._keys)
+
+    def save(self, key_path: str = None):
+        """
+        Saves the keys to `key_path` (defaults to the file they were loaded from).
+
+        Saving back to the loaded file only appends the keys added since, so earlier
+        assignments are left untouched on disk (unless the file has other columns,
+        then it is rewritten with `mrn` and `AnonID` only).
+        """
+        key_path = key_path or self.key_path
+        if key_path is None:
+            raise ValueError("No key_path to save the keys to")
+        if key_path == self.key_path and self._n_saved and _has_key_columns_only(key_path):
+            new_keys = self.keys.iloc[self._n_saved:]
+            if not new_keys.empty:
+                with open(key_path, 'rb+') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')  # Files edited by hand may end without a newline
+                new_keys.to_csv(key_path, mode='a', header=False, index=False)
+        else:
+            os.makedirs(os.path.dirname(key_path) or '.', exist_ok=True)
+            self.keys.to_csv(key_path, index=False)
+        if key_path == self.key_path:
+            self._n_saved = len(self._keys)
+        print(f"Keys saved: {key_path} ({len(self._keys)} MRNs)")
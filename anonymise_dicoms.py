@@ -17,11 +17,32 @@ Author: Kostas Moschonas
 Date: 11-04-2025
 """
 
+import io
 import pydicom
 import pandas as pd
 import os
+import queue
 import shutil
-from typing import List, Dict
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List
+
+from dedup import MODES as DEDUP_MODES, DedupIndex, content_hash
+from dicom_index import DicomIndex
+from dicom_io import DEFER_SIZE, copy_tail, find_all_tags, match_mrn, read_dicom_header, skip_element, thread_map
+from job_manifest import JobManifest, file_fingerprint
+from run_metrics import Progress, RunMetrics
+from series_metadata import ColumnarWriter, read_instance_record, set_valid_mrns
+from tag_plan import TagPlan
+from uid_map import UIDMap
+from zip_bulk import SAMPLE_SIZE, sample_compression, transfer_syntax_compression
+
+
+# Marks the end of the work in the queues of `Anonymisation._anonymise_files`
+_END = object()
+
 
 def convert_date_format(date_series: pd.Series) -> pd.Series:
     """Converts a Pandas Series of dates from YYYYMMDD to YYYYMMDD format."""
@@ -31,14 +52,26 @@ def convert_date_format(date_series: pd.Series) -> pd.Series:
 class MetadataExtraction:
     """
     Extracts metadata from DICOM files in a directory structure.
+
+    Args:
+        root_directory (str): Root of the study tree.
+        index (DicomIndex): Scanned file index of `root_directory`, built on first use if not given.
+        metrics (RunMetrics): Where stage timers and counters are recorded (a new one if not given).
     """
 
-    def __init__(self, root_directory: str):
+    def __init__(self, root_directory: str, index: DicomIndex = None, metrics: RunMetrics = None):
         if not os.path.isdir(root_directory):
             raise ValueError(f"Invalid root directory: {root_directory}")
         self.root_directory = root_directory
+        self.index = index
+        self.metrics = metrics or RunMetrics()
         self.metadata = None
 
+    def _get_index(self) -> DicomIndex:
+        if self.index is None:
+            self.index = DicomIndex(self.root_directory).scan()
+        return self.index
+
     def _find_all_tags(self, dataset, tag_keyword):
         """
         Recursively find all occurrences of a specified tag in a DICOM dataset.
@@ -50,14 +83,7 @@ class MetadataExtraction:
         Returns:
             list: A list of all values found for the specified tag.
         """
-        values = []
-        for elem in dataset:
-            if elem.VR == "SQ":  # If the element is a sequence, recurse into it
-                for item in elem.value:
-                    values.extend(self._find_all_tags(item, tag_keyword))  # Use self._find_all_tags
-            elif elem.keyword == tag_keyword:  # Check if the tag matches
-                values.append(elem.value)
-        return values
+        return find_all_tags(dataset, tag_keyword)
 
     def _extract_metadata_from_dicom(self, filepath: str, valid_mrns: set) -> Dict:
         """
@@ -65,24 +91,16 @@ class MetadataExtraction:
 
         Args:
             filepath (str): Path to the DICOM file.
-            valid_mrns (set): Set of valid MRNs to match against.
+            valid_mrns (set): Set of valid MRNs to match against (None = top-level PatientID).
 
         Returns:
             Dict: Extracted metadata or None if an error occurs.
         """
         try:
-            dcm = pydicom.dcmread(filepath)
-            patient_ids = self._find_all_tags(dcm, "PatientID")  # Use self._find_all_tags
-
-            # Match the correct MRN
-            correct_patient_id = 'NA'
-            for patient_id in patient_ids:
-                if patient_id in valid_mrns:
-                    correct_patient_id = patient_id
-                    break
-
+            # Header only: PatientID may be nested in sequences, so all header tags are kept
+            dcm = read_dicom_header(filepath)
             return {
-                'mrn': correct_patient_id,
+                'mrn': match_mrn(dcm, valid_mrns),  # Match the correct MRN, nested PatientIDs included
                 'dob': dcm.get('PatientBirthDate', 'NA'),
                 'sex': dcm.get('PatientSex', 'NA'),
                 'date': dcm.get('StudyDate', 'NA'),
@@ -96,56 +114,156 @@ class MetadataExtraction:
             print(f"Error reading DICOM {filepath}: {e}")
             return None
 
-    def extract_metadata(self, valid_mrns: set) -> pd.DataFrame:
-        study_dir_names = []
-        mrn, dob, sex, date, time, height, weight = [], [], [], [], [], [], []
-        scanner_id, study_instance_uids, file_paths = [], [], []
+    def extract_metadata(self, valid_mrns: set, io_threads: int = 1, studies: List[str] = None) -> pd.DataFrame:
+        """
+        Extracts study-level metadata from the first DICOM file of each study.
 
-        for study_dir in next(os.walk(self.root_directory))[1]:
-            study_path = os.path.join(self.root_directory, study_dir)
-            try:
-                # Check for subdirectories
-                sub_dirs = next(os.walk(study_path))[1]
-                if sub_dirs:
-                    # Process the first file in the first subdirectory
-                    first_sub_dir = sub_dirs[0]
-                    first_file = next(os.walk(os.path.join(study_path, first_sub_dir)))[2][0]
-                    filepath = os.path.join(study_path, first_sub_dir, first_file)
-                else:
-                    # Process the first DICOM file directly in the study directory
-                    first_file = next(os.walk(study_path))[2][0]
-                    filepath = os.path.join(study_path, first_file)
-            except (IndexError, StopIteration):
-                print(f"Skipping directory (no files): {study_path}")
-                continue
+        Args:
+            valid_mrns (set): Set of valid MRNs to match against.
+            io_threads (int): Number of headers read concurrently (useful on network shares).
+            studies (List[str]): If given, only these study directories are read.
 
-            dicom_metadata = self._extract_metadata_from_dicom(filepath, valid_mrns)
-            if dicom_metadata is None:
+        Returns:
+            pd.DataFrame: One row per study.
+        """
+        index = self._get_index()
+        wanted = None if studies is None else set(studies)
+        study_dirs = [s for s in index.studies() if wanted is None or s in wanted]
+        studies = []
+        for study_dir in study_dirs:
+            # Process the first DICOM file of the study (first series first)
+            filepath = index.first_dicom(study_dir)
+            if filepath is None:
+                print(f"Skipping directory (no DICOM files): {os.path.join(self.root_directory, study_dir)}")
                 continue
+            studies.append((study_dir, filepath))
+
+        def read(study):
+            start = time.perf_counter()
+            return self._extract_metadata_from_dicom(study[1], valid_mrns), time.perf_counter() - start
 
-            study_dir_names.append(study_dir)
-            mrn.append(dicom_metadata['mrn'])
-            dob.append(dicom_metadata['dob'])
-            sex.append(dicom_metadata['sex'])
-            date.append(dicom_metadata['date'])
-            time.append(dicom_metadata['time'])
-            height.append(dicom_metadata['height'])
-            weight.append(dicom_metadata['weight'])
-            scanner_id.append(dicom_metadata['scanner_id'])
-            study_instance_uids.append(dicom_metadata['StudyInstanceUID'])
-            file_paths.append(filepath)
-
-        df = pd.DataFrame({
-            'AnonID': [''] * len(study_dir_names),
-            'StudyDirName': study_dir_names,
-            'mrn': mrn, 'dob': dob, 'sex': sex, 'date': date,
-            'time': time, 'StudyInstanceUID': study_instance_uids,
-            'height': height, 'weight': weight, 'scanner_id': scanner_id,
-            'FilePath': file_paths,
-        })
-        self.metadata = self._convert_column_formats(df)
+        rows = []
+        with self.metrics.run_stage('metadata') as stage:
+            progress = Progress('metadata', len(studies))
+            for (study_dir, filepath), (dicom_metadata, seconds) in zip(studies, thread_map(read, studies, io_threads)):
+                stage.timers['read'] += seconds
+                stage.count(files=1, errors=int(dicom_metadata is None))
+                progress.update()
+                if dicom_metadata is None:
+                    continue
+                rows.append({'StudyDirName': study_dir, **dicom_metadata, 'FilePath': filepath})
+
+        self.metadata = self._metadata_dataframe(rows)
         return self.metadata
 
+    def extract_instance_metadata(self, output_path: str, valid_mrns: set = None, n_workers: int = None,
+                                  batch_size: int = 10000, io_threads: int = None) -> int:
+        """
+        Extracts per-instance metadata (UIDs, protocol, scanner, frames...) from every DICOM file
+        and writes it in typed columnar batches to Parquet (or Arrow IPC for `.arrow`/`.feather`).
+
+        Headers are read concurrently by a pool of worker processes (or of threads with
+        `io_threads`, better suited to network shares where per-file latency dominates),
+        one batch of `batch_size` files at a time, so memory stays bounded for very large cohorts.
+        Use `series_metadata.series_summary` for per-series counts.
+
+        Args:
+            output_path (str): Parquet or Arrow IPC file to write.
+            valid_mrns (set): Set of valid MRNs to match (nested PatientIDs included); if not given
+                the top-level PatientID is used.
+            n_workers (int): Number of worker processes (1 = read in this process).
+            batch_size (int): Number of files per batch (and per Parquet row group).
+            io_threads (int): If given, read with this many concurrent threads instead of processes.
+
+        Returns:
+            int: Number of rows written.
+        """
+        files = [f for f in self._get_index().files if f.is_dicom]
+        tasks = [(f.path, f.study, f.series, f.size) for f in files]
+
+        # The MRNs go to each worker once, not with every task (key registries can hold millions)
+        use_processes = n_workers != 1 and not io_threads
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=n_workers, initializer=set_valid_mrns, initargs=(valid_mrns,))
+        else:
+            executor = None
+            set_valid_mrns(valid_mrns)
+        try:
+            with self.metrics.run_stage('instance_metadata') as stage, ColumnarWriter(output_path) as writer:
+                progress = Progress('instance_metadata', len(tasks))
+                for start in range(0, len(tasks), batch_size):
+                    batch = tasks[start:start + batch_size]
+                    with stage.timer('read'):  # Wall time of the batch, however many readers
+                        if executor is None:
+                            records = list(thread_map(read_instance_record, batch, io_threads))
+                        else:
+                            records = list(executor.map(read_instance_record, batch, chunksize=64))
+                    records = [r for r in records if r is not None]
+                    with stage.timer('write'):
+                        writer.write(records)
+                    stage.count(files=len(batch), errors=len(batch) - len(records))
+                    progress.update(len(batch))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        print(f"Instance metadata saved to {output_path} ({writer.rows_written} rows)")
+        return writer.rows_written
+
+    def extract_metadata_from_zips(self, valid_mrns: set, studies: List[str] = None) -> pd.DataFrame:
+        """
+        Extracts metadata from zipped studies (one zip per study) without extracting them.
+
+        The header of the first DICOM member of each zip is read straight from the archive;
+        StudyDirName is the zip name without its extension.
+
+        Args:
+            valid_mrns (set): Set of valid MRNs to match against.
+            studies (List[str]): If given, only the zips of these studies (names without `.zip`) are read.
+
+        Returns:
+            pd.DataFrame: Metadata with the same columns as `extract_metadata`.
+        """
+        rows = []
+        wanted = None if studies is None else set(studies)
+        zips = [f for f in self._get_index().study_files('')
+                if (wanted is None or os.path.splitext(f.rel_path)[0] in wanted) and zipfile.is_zipfile(f.path)]
+        with self.metrics.run_stage('metadata') as stage:
+            progress = Progress('metadata', len(zips), unit='zips')
+            for indexed in zips:
+                zip_name, zip_path = indexed.rel_path, indexed.path
+                dicom_metadata = None
+                with stage.timer('read'), zipfile.ZipFile(zip_path) as zip_ref:
+                    for info in zip_ref.infolist():
+                        if info.is_dir():
+                            continue
+                        try:
+                            with zip_ref.open(info) as member:
+                                read_dicom_header(member, specific_tags=['SOPClassUID'])
+                        except pydicom.errors.InvalidDicomError:
+                            continue  # Not a DICOM member
+                        with zip_ref.open(info) as member:
+                            dicom_metadata = self._extract_metadata_from_dicom(member, valid_mrns)
+                        filepath = os.path.join(zip_path, info.filename)
+                        break
+                stage.count(files=1)
+                progress.update()
+                if dicom_metadata is None:
+                    print(f"Skipping zip (no DICOM files): {zip_path}")
+                    stage.count(skipped=1)
+                    continue
+                rows.append({'StudyDirName': os.path.splitext(zip_name)[0], **dicom_metadata, 'FilePath': filepath})
+
+        self.metadata = self._metadata_dataframe(rows)
+        return self.metadata
+
+    def _metadata_dataframe(self, rows: List[Dict]) -> pd.DataFrame:
+        """Builds the typed metadata DataFrame from per-study rows."""
+        columns = ['StudyDirName', 'mrn', 'dob', 'sex', 'date', 'time', 'StudyInstanceUID',
+                   'height', 'weight', 'scanner_id', 'FilePath']
+        df = pd.DataFrame(rows, columns=columns)
+        df.insert(0, 'AnonID', '')
+        return self._convert_column_formats(df)
+
     def _convert_column_formats(self, df: pd.DataFrame) -> pd.DataFrame:
         str_cols = ['StudyDirName', 'mrn', 'sex', 'StudyInstanceUID', 'FilePath']
         df[str_cols] = df[str_cols].astype(str)
@@ -170,20 +288,79 @@ class Anonymisation:
     """
     Handles anonymization of DICOM files, keeping the original directory structure,
     and in-place DICOM tag modification.
+
+    Args:
+        tag_rules (Dict): Anonymisation rules per tag keyword (see `tag_plan`), defaults to `DEFAULT_TAG_RULES`.
+        uid_salt (str): Salt for the 'hash_uid' action and `hash_all_uids`; keep it secret and the same
+            for every run of a project.
+        metrics (RunMetrics): Where stage timers and counters are recorded (a new one if not given).
+        pixel_passthrough (bool): Parse and rewrite only the header, and copy the pixel data (and the
+            rest of the file after it) byte for byte from the source, without ever loading it.
+        hash_all_uids (bool): Replace every instance UID (study, series, SOP instance, frame of reference,
+            referenced instances in nested sequences...) with a salted hash, consistently across files.
+        uid_map_path (str): SQLite file recording the original -> anonymised UIDs across runs (see `uid_map`).
+        read_queue_size (int): Files read ahead of the tag rewrite (0 = read, rewrite and write one file at a time).
+        write_queue_size (int): Rewritten files waiting to be written behind (0 = no write-behind).
+        dedup (str): 'link' to hard-link, or 'skip' to leave out, files whose anonymised output was already
+            written (same SOPInstanceUID, content, AnonID and rules; see `dedup`). When anonymising in
+            place, 'skip' deletes the duplicate copy. None = no deduplication.
+        dedup_path (str): Dedup index shared across runs, so outputs of earlier runs are found too
+            (None = only duplicates within this process).
+        large_file_size (int): Files (and zip members) of at least this many bytes are always anonymised
+            by rewriting the header and streaming the pixel data through, with large header values left
+            on disk until written, so memory stays bounded whatever their size; those that cannot be
+            (deflated, or rules after the pixel data) are reported as errors rather than loaded whole.
+            None = no limit.
     """
 
+    def __init__(self, tag_rules: Dict = None, uid_salt: str = '', metrics: RunMetrics = None,
+                 pixel_passthrough: bool = True, hash_all_uids: bool = False, uid_map_path: str = None,
+                 read_queue_size: int = 4, write_queue_size: int = 4, dedup: str = None, dedup_path: str = None,
+                 large_file_size: int = 1024 ** 3):
+        # Compiled once per run rather than per file
+        self.tag_plan = TagPlan(tag_rules, hash_all_uids=hash_all_uids, uid_map=UIDMap(uid_salt, uid_map_path))
+        self.metrics = metrics or RunMetrics()
+        # Only if no rule targets the elements after the pixel data (padding, signatures)
+        self._tail_untouched = all(tag < 0x7FE00008 for tag in self.tag_plan.tags)
+        self.pixel_passthrough = pixel_passthrough and self._tail_untouched
+        self.large_file_size = large_file_size
+        self.read_queue_size = read_queue_size
+        self.write_queue_size = write_queue_size
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError(f"Invalid dedup: {dedup}, expected one of {DEDUP_MODES}")
+        self.dedup = dedup
+        self.dedup_index = DedupIndex(dedup_path) if dedup else None
+
+    def flush(self):
+        """Saves the UIDs and dedup records of the files written so far."""
+        self.tag_plan.uid_map.flush()
+        if self.dedup_index is not None:
+            self.dedup_index.flush()
+
+    def close(self):
+        self.tag_plan.uid_map.close()
+        if self.dedup_index is not None:
+            self.dedup_index.close()
+
     def copy_directory(self, source_dir: str, destination_dir: str):
         """Copies the entire directory structure from source to destination."""
         if not os.path.exists(destination_dir):
             os.makedirs(destination_dir)
 
-        for item in os.listdir(source_dir):
-            source_path = os.path.join(source_dir, item)
-            destination_path = os.path.join(destination_dir, item)
-            if os.path.isdir(source_path):
-                shutil.copytree(source_path, destination_path, dirs_exist_ok=True)
-            else:
-                shutil.copy2(source_path, destination_path)
+        with self.metrics.run_stage('copy') as stage:
+            def copy(source_path, destination_path):
+                with stage.timer('write'):
+                    shutil.copy2(source_path, destination_path)
+                stage.count(files=1, bytes=os.path.getsize(destination_path))
+                return destination_path
+
+            for item in os.listdir(source_dir):
+                source_path = os.path.join(source_dir, item)
+                destination_path = os.path.join(destination_dir, item)
+                if os.path.isdir(source_path):
+                    shutil.copytree(source_path, destination_path, copy_function=copy, dirs_exist_ok=True)
+                else:
+                    copy(source_path, destination_path)
 
 
     def rename_mainfolders(self, anon_dir: str, df: pd.DataFrame):
@@ -203,71 +380,745 @@ class Anonymisation:
             except OSError as e:
                 print(f"Error renaming: {e}")
 
-    def _anonymize_tags(self, dataset, tag_replacements):
+    def _iter_study_files(self, anon_dir: str, df: pd.DataFrame, index: DicomIndex = None):
         """
-        Recursively anonymize specified tags in a DICOM dataset.
+        Yields (file path, AnonID, output path) for every file in the renamed study directories.
 
         Args:
-            dataset (pydicom.dataset.Dataset): The DICOM dataset to anonymize.
-            tag_replacements (dict): A dictionary of tag keywords and their replacement values.
+            anon_dir (str): Path to the directory containing anonymized DICOM files.
+            df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            index (DicomIndex): Index of the source tree that was copied to `anon_dir`;
+                if given, the file list comes from the index instead of walking `anon_dir`.
         """
-        for elem in dataset:
-            if elem.VR == "SQ":  # If the element is a sequence, recurse into it
-                for item in elem.value:
-                    self._anonymize_tags(item, tag_replacements)  # Use self._anonymize_tags
-            elif elem.keyword in tag_replacements:  # Check if the tag matches
-                elem.value = tag_replacements[elem.keyword]
+        for _, row in df.iterrows():
+            study_dir_path = os.path.join(anon_dir, f"{row['AnonID']}_{row['formatted_date']}")
 
+            if not os.path.exists(study_dir_path):
+                print(f"Warning: Directory not found: {study_dir_path}")
+                continue
 
-    def anonymise_dicom_tags(self, anon_dir: str, df: pd.DataFrame):
+            if index is not None:
+                study = os.path.basename(str(row['StudyDirName']))
+                for indexed in index.study_files(study):
+                    file_path = os.path.join(study_dir_path, os.path.relpath(indexed.rel_path, study))
+                    yield file_path, str(row['AnonID']), file_path
+                continue
+
+            for root, _, files in os.walk(study_dir_path):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    yield file_path, str(row['AnonID']), file_path
+
+    def _iter_source_files(self, source_dir: str, anon_dir: str, df: pd.DataFrame, index: DicomIndex = None):
         """
-        Anonymizes DICOM files in place within the specified directory.
+        Yields (source path, AnonID, output path) for every file in the original study directories,
+        where the output path is the final location under `<AnonID>_<formatted_date>` in `anon_dir`.
 
         Args:
-            anon_dir (str): Path to the directory containing anonymized DICOM files.
+            source_dir (str): Path to the directory containing the original studies.
+            anon_dir (str): Path to the destination directory for anonymized studies.
             df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            index (DicomIndex): Index of `source_dir`; if given, it is used instead of walking the studies.
         """
         for _, row in df.iterrows():
-            study_dir_path = os.path.join(anon_dir, f"{row['AnonID']}_{row['formatted_date']}")
+            study = os.path.basename(str(row['StudyDirName']))
+            study_dir_path = os.path.join(source_dir, study)
+            anon_study_path = os.path.join(anon_dir, f"{row['AnonID']}_{row['formatted_date']}")
+
+            if index is not None:
+                if not index.study_files(study):
+                    print(f"Warning: Directory not found in index: {study_dir_path}")
+                for indexed in index.study_files(study):
+                    output_path = os.path.join(anon_study_path, os.path.relpath(indexed.rel_path, study))
+                    yield indexed.path, str(row['AnonID']), output_path
+                continue
 
             if not os.path.exists(study_dir_path):
                 print(f"Warning: Directory not found: {study_dir_path}")
                 continue
 
             for root, _, files in os.walk(study_dir_path):
+                out_root = os.path.join(anon_study_path, os.path.relpath(root, study_dir_path))
                 for file in files:
-                    dcm_file_path = os.path.join(root, file)
-                    try:
-                        ds = pydicom.dcmread(dcm_file_path, force=True)
-
-                        # Define replacements for anonymization
-                        tag_replacements = {
-                            'PatientName': str(row['AnonID']),
-                            'PatientID': str(row['AnonID']),
-                        }
-
-                        # Empty other sensitive tags
-                        empty_tags = [
-                            'PatientBirthDate', 'PhysicianOfRecord', 'PhysiciansOfRecord',
-                            'RequestingPhysician', 'PerformingPhysicianName', 'OperatorName',
-                            'OperatorsName', 'InstitutionAddress', 'ReferringPhysicianName',
-                            'OtherPatientIDs', 'ReferencedStudySequence', 'StudyID',
-                            'PatientTelephoneNumber', 'InstitutionName'
-                        ]
-                        for tag_name in empty_tags:
-                            tag_replacements[tag_name] = ''
-
-                        # Anonymize tags recursively
-                        self._anonymize_tags(ds, tag_replacements)
-
-                        ds.save_as(dcm_file_path)
-                        print(f"Anonymized: {dcm_file_path}")
-
-                    except pydicom.errors.InvalidDicomError:
-                        # Not a DICOM file, skip
+                    yield os.path.join(root, file), str(row['AnonID']), os.path.normpath(os.path.join(out_root, file))
+
+    def _read_dataset(self, file_path, stop_before_pixels: bool = False, defer_size: int = None):
+        """
+        Reads a DICOM file (path or seekable binary file), also accepting files without a preamble.
+
+        Raises:
+            pydicom.errors.InvalidDicomError: If the file is not a DICOM file.
+        """
+        try:
+            return pydicom.dcmread(file_path, stop_before_pixels=stop_before_pixels, defer_size=defer_size)
+        except pydicom.errors.InvalidDicomError as e:
+            error = e
+
+        # Files written without the 128-byte preamble are still valid DICOM
+        try:
+            if hasattr(file_path, 'seek'):
+                file_path.seek(0)
+            ds = pydicom.dcmread(file_path, stop_before_pixels=stop_before_pixels, defer_size=defer_size, force=True)
+            if 'SOPClassUID' in ds or 'TransferSyntaxUID' in ds.file_meta:
+                return ds
+        except Exception:
+            pass
+        raise error
+
+    def _is_large(self, size: int) -> bool:
+        return self.large_file_size is not None and size >= self.large_file_size
+
+    def _read_for_rewrite(self, src, large: bool = False, defer_size: int = None):
+        """
+        Reads an open DICOM file to anonymize it.
+
+        With `pixel_passthrough`, only the header is parsed and the offset where the pixel data
+        starts is returned as well, so the rest of the file can be copied as is after the
+        rewritten header. Otherwise (or if the file's encoding does not allow it, or elements
+        after the pixel data may hold a targeted tag) the whole dataset is read and the offset
+        is None. A `large` file is always passed through.
+
+        Args:
+            src: Open binary DICOM file.
+            large (bool): The file is above `large_file_size`.
+            defer_size (int): Header values larger than this are read when accessed (only for files opened by path).
+
+        Returns:
+            Tuple: (dataset, pixel data offset or None).
+
+        Raises:
+            pydicom.errors.InvalidDicomError: If the file is not a DICOM file.
+            ValueError: If a large file cannot be passed through.
+        """
+        if self.pixel_passthrough or large:
+            ds = self._read_dataset(src, stop_before_pixels=True, defer_size=defer_size)
+            offset = src.tell()
+            if self._can_pass_through(ds) and self._tail_untouched and self._after_pixels_untouched(src, ds):
+                src.seek(offset)
+                return ds, offset
+            if large:
+                raise ValueError(f"File is above large_file_size ({self.large_file_size} bytes) and its pixel data "
+                                 "cannot be passed through (deflated, or rules after the pixel data)")
+            src.seek(0)
+        return self._read_dataset(src), None
+
+    def _after_pixels_untouched(self, src, ds, block_size: int = 1024 * 1024) -> bool:
+        """
+        Checks that no rule applies to the elements after the pixel data (e.g. UIDs nested in a
+        digital signatures sequence), which would otherwise be copied through unchanged. `src` is
+        at the pixel data element; the pixel data itself is skipped, not read.
+        """
+        try:
+            if not skip_element(src, *ds.original_encoding):
+                return True  # No pixel data, the header is the whole file
+        except ValueError:
+            return False  # Malformed pixel data element, read the whole dataset instead
+        previous = b''
+        for block in iter(lambda: src.read(block_size), b''):
+            # The end of the previous block is kept, so a tag split across blocks is found too
+            if self.tag_plan.may_target(previous[-3:] + block):
+                return False
+            previous = block
+        return True
+
+    def _can_pass_through(self, ds) -> bool:
+        """Checks that the header will be written back in the encoding of the original pixel data bytes."""
+        tsyntax = ds.file_meta.get('TransferSyntaxUID')
+        if tsyntax is None or not tsyntax.is_transfer_syntax or tsyntax.is_deflated:
+            return False  # Deflated datasets are compressed as a whole, the tail cannot be spliced
+        return ds.original_encoding == (tsyntax.is_implicit_VR, tsyntax.is_little_endian)
+
+    def _anonymise_file(self, dcm_file_path: str, anon_id: str, output_path: str = None) -> Dict:
+        """
+        Anonymizes a single DICOM file, in place or into `output_path`.
+
+        When writing to `output_path`, non-DICOM files are copied unchanged.
+
+        Args:
+            dcm_file_path (str): Path to the DICOM file.
+            anon_id (str): AnonID of the study the file belongs to.
+            output_path (str): Destination path, defaults to `dcm_file_path`.
+
+        Returns:
+            Dict: Per-file summary with FilePath, AnonID, OutputPath, status and error,
+                plus the file size (bytes) and seconds spent reading, walking tags and writing.
+        """
+        return self._write_step(self._rewrite_step(self._read_step(dcm_file_path, anon_id, output_path)))
+
+    def _read_step(self, dcm_file_path: str, anon_id: str, output_path: str = None) -> Dict:
+        """
+        First step of `_anonymise_file`: reads the file's dataset (only the header with `pixel_passthrough`).
+
+        With `dedup`, the file's content is hashed too, and a file whose output was already
+        written is marked as a duplicate ('linked' or 'duplicate'), without a dataset.
+
+        Returns:
+            Dict: Work item with the per-file `result`, the dataset `ds` (None if not a DICOM file),
+                `pixel_offset`, `dedup_key`, `duplicate_of` and, later, the encoded `header`.
+        """
+        output_path = output_path or dcm_file_path
+        result = {'FilePath': dcm_file_path, 'AnonID': anon_id, 'OutputPath': output_path,
+                  'status': 'anonymised', 'error': '', 'bytes': 0, 'read_s': 0.0, 'tag_walk_s': 0.0, 'write_s': 0.0}
+        item = {'result': result, 'ds': None, 'pixel_offset': None, 'header': None,
+                'dedup_key': None, 'duplicate_of': None, 'remove': False}
+        start = time.perf_counter()
+        try:
+            result['bytes'] = os.path.getsize(dcm_file_path)
+            with open(dcm_file_path, 'rb') as src:
+                large = self._is_large(result['bytes'])
+                try:
+                    item['ds'], item['pixel_offset'] = self._read_for_rewrite(src, large, DEFER_SIZE if large else None)
+                except pydicom.errors.InvalidDicomError:
+                    pass
+                if self.dedup_index is not None and item['ds'] is not None and item['ds'].get('SOPInstanceUID'):
+                    self._check_duplicate(item, src)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+        result['read_s'] = time.perf_counter() - start
+        return item
+
+    def _check_duplicate(self, item: Dict, src):
+        """Looks up the file's dedup key, and marks the item as a duplicate or reserves the key for it."""
+        result = item['result']
+        key = (str(item['ds'].SOPInstanceUID), content_hash(src), str(result['AnonID']), self.tag_plan.fingerprint)
+        item['dedup_key'] = key
+        existing = self.dedup_index.lookup(key)
+        if existing is None:
+            self.dedup_index.reserve(key, result['OutputPath'])
+            return
+        item['ds'] = None
+        output_path = result['OutputPath']
+        if existing == output_path or (os.path.exists(output_path) and os.path.samefile(existing, output_path)):
+            result['status'] = 'duplicate'  # Already written or linked there (e.g. a re-run)
+        elif self.dedup == 'skip':
+            result['status'] = 'duplicate'
+            # In place, the duplicate is the identifiable copy in anon_dir, which must not be left there
+            item['remove'] = output_path == result['FilePath']
+        else:
+            result['status'] = 'linked'
+            item['duplicate_of'] = existing
+
+    def _rewrite_step(self, item: Dict) -> Dict:
+        """
+        Second step of `_anonymise_file`: applies the tag plan and, with pixel data passed
+        through, encodes the header, so the write step only has bytes to write.
+        """
+        result = item['result']
+        if item['ds'] is None or result['status'] != 'anonymised':
+            return item
+        try:
+            start = time.perf_counter()
+            # Anonymize tags, including those nested in sequences
+            self.tag_plan.apply(item['ds'], result['AnonID'])
+            walk_done = time.perf_counter()
+            result['tag_walk_s'] = walk_done - start
+            if item['pixel_offset'] is not None:
+                header = io.BytesIO()
+                item['ds'].save_as(header)
+                item['header'] = header.getbuffer()
+                item['ds'] = None
+                result['write_s'] = time.perf_counter() - walk_done
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+        return item
+
+    def _write_step(self, item: Dict) -> Dict:
+        """
+        Last step of `_anonymise_file`: writes the anonymized file (header, then the pixel data
+        copied from the source), hard-links a duplicate to the output of its first copy,
+        or copies/skips a non-DICOM file.
+
+        Returns:
+            Dict: The per-file result.
+        """
+        result = item['result']
+        if result['status'] == 'duplicate' and item['remove']:
+            try:
+                os.remove(result['OutputPath'])
+            except OSError as e:
+                result['status'] = 'error'
+                result['error'] = f"Duplicate could not be removed: {e}"
+            return result
+        if result['status'] in ('error', 'duplicate'):
+            if item['dedup_key'] is not None and result['status'] == 'error':
+                self.dedup_index.release(item['dedup_key'])
+            return result
+        dcm_file_path, output_path = result['FilePath'], result['OutputPath']
+        part_path = output_path + '.part'
+        start = time.perf_counter()
+        try:
+            if output_path != dcm_file_path:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            if item['duplicate_of'] is not None:
+                # Only once the first copy has been written (it may have been in the queue ahead of this one)
+                if self.dedup_index.lookup(item['dedup_key'], include_pending=False) is None:
+                    raise RuntimeError(f"Duplicate of {item['duplicate_of']}, which was not written")
+                if os.path.exists(part_path):
+                    os.remove(part_path)  # Left over from an interrupted run
+                try:
+                    os.link(item['duplicate_of'], part_path)
+                except OSError:
+                    shutil.copy2(item['duplicate_of'], part_path)  # Other drive, or no hard links
+                os.replace(part_path, output_path)
+                result['write_s'] = time.perf_counter() - start
+                return result
+
+            if item['ds'] is None and item['header'] is None:
+                # Not a DICOM file, skip (or copy it over unchanged)
+                if output_path != dcm_file_path:
+                    shutil.copy2(dcm_file_path, output_path)
+                    result['write_s'] = time.perf_counter() - start
+                    result['status'] = 'copied'
+                else:
+                    result['status'] = 'skipped'
+                return result
+
+            # Written next to the output and renamed, as the source may be the output
+            with open(part_path, 'wb') as dst:
+                if item['header'] is None:
+                    item['ds'].save_as(dst)
+                else:
+                    dst.write(item['header'])
+                    with open(dcm_file_path, 'rb') as src:
+                        copy_tail(src, dst, item['pixel_offset'])  # Pixel data copied byte for byte
+            os.replace(part_path, output_path)
+            result['write_s'] += time.perf_counter() - start
+            if item['dedup_key'] is not None:
+                self.dedup_index.record(item['dedup_key'], output_path)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if item['dedup_key'] is not None and item['duplicate_of'] is None:
+                self.dedup_index.release(item['dedup_key'])
+        return result
+
+    def _anonymise_files(self, tasks: Iterable) -> Iterator[Dict]:
+        """
+        Anonymizes (file path, AnonID, output path) tasks, yielding their results in order.
+
+        With queue sizes set, the three steps of `_anonymise_file` run as a pipeline: a reader
+        thread reads ahead, this thread rewrites the tags and a writer thread writes behind,
+        so disk and CPU work overlap. The bounded queues between them block the faster
+        stage (backpressure), so at most `read_queue_size + write_queue_size` files are held
+        in memory. Files already handed to the writer are still written if the caller stops early.
+        """
+        if not self.read_queue_size or not self.write_queue_size:
+            for task in tasks:
+                yield self._anonymise_file(*task)
+            return
+
+        read_queue = queue.Queue(self.read_queue_size)
+        write_queue = queue.Queue(self.write_queue_size)
+        done_queue = queue.Queue()
+        stop = threading.Event()
+        failures = []
+
+        # Queue operations give up once a stage has stopped, instead of blocking on a stage that is gone
+        def put(target, item):
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(source):
+            while True:
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return _END
+
+        def read():
+            try:
+                for task in tasks:
+                    if not put(read_queue, self._read_step(*task)):
+                        return
+            except BaseException as e:
+                failures.append(e)
+                stop.set()
+            finally:
+                put(read_queue, _END)
+
+        def write():
+            try:
+                while True:
+                    item = get(write_queue)  # Still drains the queue after a stop
+                    if item is _END:
+                        return
+                    done_queue.put(self._write_step(item))
+            except BaseException as e:
+                failures.append(e)
+                stop.set()
+
+        reader = threading.Thread(target=read, name='anonymise-reader', daemon=True)
+        writer = threading.Thread(target=write, name='anonymise-writer', daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            while not stop.is_set():
+                item = get(read_queue)
+                if item is _END or not put(write_queue, self._rewrite_step(item)):
+                    break
+                while not done_queue.empty():
+                    yield done_queue.get()
+            put(write_queue, _END)
+            writer.join()
+            while not done_queue.empty():
+                yield done_queue.get()
+            if failures:
+                raise failures[0]
+        finally:
+            stop.set()
+            reader.join()
+            writer.join()
+
+    def _anonymise_zip(self, zip_path: str, anon_id: str, output_zip: str) -> List[Dict]:
+        """
+        Anonymizes every member of a study zip in memory and writes them into `output_zip`,
+        under a top-level folder named after the output zip (as `zip_bulk.zip_folder` would).
+
+        Members that fail to anonymize are left out of the output zip. The zip is written
+        under a `.part` name and only renamed once complete. Members above `large_file_size`
+        are streamed from the source zip rather than read into memory. With `dedup`, a member with the
+        same SOPInstanceUID and content as an earlier member of the zip is left out too
+        (members cannot be hard-linked, so duplicates are only looked for within a zip).
+
+        Args:
+            zip_path (str): Path to the source study zip.
+            anon_id (str): AnonID of the study.
+            output_zip (str): Path of the anonymized zip, `<AnonID>_<formatted_date>.zip`.
+
+        Returns:
+            List[Dict]: Per-member summary with FilePath, AnonID, OutputPath, status and error.
+        """
+        results = []
+        folder = os.path.splitext(os.path.basename(output_zip))[0]
+        part_path = output_zip + '.part'
+        seen = set()
+        try:
+            os.makedirs(os.path.dirname(output_zip) or '.', exist_ok=True)
+            with zipfile.ZipFile(zip_path) as src, zipfile.ZipFile(part_path, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    if info.is_dir():
                         continue
+                    arcname = f"{folder}/{info.filename}"
+                    result = {'FilePath': os.path.join(zip_path, info.filename), 'AnonID': anon_id,
+                              'OutputPath': os.path.join(output_zip, arcname), 'status': 'anonymised', 'error': '',
+                              'bytes': info.file_size, 'read_s': 0.0, 'tag_walk_s': 0.0, 'write_s': 0.0}
+                    # Large members are streamed from the source zip instead of being read into memory
+                    large = self._is_large(info.file_size)
+                    start = time.perf_counter()
+                    try:
+                        with (src.open(info) if large else io.BytesIO(src.read(info))) as member:
+                            header = io.BytesIO()
+                            try:
+                                ds, pixel_offset = self._read_for_rewrite(member, large)
+                            except pydicom.errors.InvalidDicomError:
+                                result['status'] = 'copied'  # Not a DICOM file, copy it over unchanged
+                                pixel_offset = 0
+                                member.seek(0)
+                                compress_type = sample_compression(member.read(SAMPLE_SIZE))
+                                read_done = walk_done = time.perf_counter()
+                            else:
+                                read_done = time.perf_counter()
+                                if self.dedup and ds.get('SOPInstanceUID'):
+                                    key = (str(ds.SOPInstanceUID), content_hash(member))
+                                    if key in seen:
+                                        result['status'] = 'duplicate'
+                                        result['read_s'] = read_done - start
+                                        results.append(result)
+                                        continue
+                                    seen.add(key)
+                                self.tag_plan.apply(ds, anon_id)
+                                walk_done = time.perf_counter()
+                                ds.save_as(header)
+                                # Compressed pixel data is stored as it is rather than deflated again
+                                compress_type = transfer_syntax_compression(ds.file_meta.get('TransferSyntaxUID'))
+                                if compress_type is None:
+                                    member.seek(0)
+                                    compress_type = sample_compression(member.read(SAMPLE_SIZE))
+                                if pixel_offset is None:
+                                    pixel_offset = info.file_size  # Whole dataset rewritten
+                            zinfo = zipfile.ZipInfo(arcname, date_time=info.date_time)
+                            zinfo.compress_type = compress_type
+                            with dst.open(zinfo, 'w', force_zip64=large) as out:
+                                out.write(header.getbuffer())
+                                if large:
+                                    member.seek(pixel_offset)
+                                    shutil.copyfileobj(member, out, 1024 * 1024)
+                                else:
+                                    out.write(member.getbuffer()[pixel_offset:])  # Pixel data as read, without copies
+                        result['read_s'] = read_done - start
+                        result['tag_walk_s'] = walk_done - read_done
+                        result['write_s'] = time.perf_counter() - walk_done
                     except Exception as e:
-                        print(f"Error anonymizing {dcm_file_path}: {e}")
-                        return False  # Stop on error
+                        result['status'] = 'error'
+                        result['error'] = str(e)
+                    results.append(result)
+            os.replace(part_path, output_zip)
+        except Exception as e:
+            results.append({'FilePath': zip_path, 'AnonID': anon_id, 'OutputPath': output_zip,
+                            'status': 'error', 'error': str(e)})
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return results
 
+    def _run_tasks(self, tasks: List, n_workers: int = None, split_by: str = 'study', chunk_size: int = 500,
+                   manifest_path: str = None, worker=None, stage_name: str = 'anonymise',
+                   manifest_rows=None) -> pd.DataFrame:
+        """
+        Runs (file path, AnonID, output path) tasks in batches, in a pool of worker processes
+        unless `n_workers` is 1, and collects the per-file results.
+
+        Args:
+            tasks (List): Tuples of (file path, AnonID, output path).
+            n_workers (int): Number of worker processes (defaults to the CPU count).
+            split_by (str): 'study' for one batch per study, 'chunk' for batches of `chunk_size` files.
+            chunk_size (int): Number of files per batch when splitting by chunk.
+            manifest_path (str): Job manifest to resume from and record into (see `job_manifest`).
+            worker: Batch function run for each batch, defaults to `_anonymise_file_batch`.
+            stage_name (str): Stage the results are recorded under in `metrics`.
+            manifest_rows: Function of (batch, batch results) returning the rows to record in the
+                manifest, one per task; defaults to the results themselves (one per file).
+
+        Returns:
+            pd.DataFrame: Per-file summary with FilePath, AnonID, OutputPath, status and error columns.
+        """
+        if split_by not in ('study', 'chunk'):
+            raise ValueError(f"Invalid split_by: {split_by}")
+
+        unit = 'zips' if worker is _anonymise_zip_batch else 'files'
+        manifest = JobManifest(manifest_path) if manifest_path else None
+        if manifest is not None:
+            n_tasks = len(tasks)
+            tasks = manifest.pending(tasks)
+            print(f"Manifest {manifest_path}: {n_tasks - len(tasks)} {unit} already done, {len(tasks)} to process")
+
+        if split_by == 'study':
+            batches = {}
+            for task in tasks:
+                batches.setdefault(task[1], []).append(task)
+            batches = list(batches.values())
+        else:
+            batches = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+        worker = worker or _anonymise_file_batch
+        results = [None] * len(batches)
+        fingerprint = manifest is not None
+        with self.metrics.run_stage(stage_name) as stage:
+            progress = Progress(stage_name, len(tasks), unit=unit)
+
+            def collect(i, batch_results):
+                results[i] = batch_results
+                if manifest is not None:
+                    manifest.record(manifest_rows(batches[i], batch_results) if manifest_rows else batch_results)
+                for result in batch_results:
+                    stage.add_result(result)
+                progress.update(len(batches[i]), sum(r.get('bytes', 0) for r in batch_results))
+
+            if n_workers == 1:
+                for i, batch in enumerate(batches):
+                    collect(i, worker(self, batch, fingerprint))
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    futures = {executor.submit(worker, self, batch, fingerprint): i
+                               for i, batch in enumerate(batches)}
+                    for future in as_completed(futures):
+                        i = futures[future]
+                        try:
+                            batch_results = future.result()
+                        except Exception as e:
+                            # The worker itself failed (e.g. crashed), mark the whole batch
+                            batch_results = [{'FilePath': path, 'AnonID': anon_id, 'OutputPath': output_path,
+                                              'status': 'error', 'error': str(e)}
+                                             for path, anon_id, output_path in batches[i]]
+                        collect(i, batch_results)
+        if manifest is not None:
+            manifest.close()
+
+        summary = pd.DataFrame([r for batch in results for r in batch],
+                               columns=['FilePath', 'AnonID', 'OutputPath', 'status', 'error'])
+        counts = summary['status'].value_counts()
+        n_duplicates = counts.get('linked', 0) + counts.get('duplicate', 0)
+        print(f"Anonymized {counts.get('anonymised', 0)} files, copied {counts.get('copied', 0)}, "
+              f"skipped {counts.get('skipped', 0)}, duplicates {n_duplicates}, errors {counts.get('error', 0)}")
+        return summary
+
+    def anonymise_dicom_tags(self, anon_dir: str, df: pd.DataFrame, index: DicomIndex = None):
+        """
+        Anonymizes DICOM files in place within the specified directory.
+
+        Reading, tag rewriting and writing overlap through bounded queues (see `_anonymise_files`).
+
+        Args:
+            anon_dir (str): Path to the directory containing anonymized DICOM files.
+            df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            index (DicomIndex): Index of the source tree copied to `anon_dir`, used instead of walking it.
+        """
+        tasks = list(self._iter_study_files(anon_dir, df, index))
+        with self.metrics.run_stage('anonymise') as stage:
+            progress = Progress('anonymise', len(tasks))
+            results = self._anonymise_files(tasks)  # Reads ahead and writes behind
+            for result in results:
+                stage.add_result(result)
+                progress.update(1, result['bytes'])
+                if result['status'] == 'error':
+                    print(f"Error anonymizing {result['FilePath']}: {result['error']}")
+                    results.close()
+                    self.flush()
+                    return False  # Stop on error
+
+        self.flush()
         return True
+
+    def anonymise_dicom_tags_parallel(self, anon_dir: str, df: pd.DataFrame, n_workers: int = None,
+                                      split_by: str = 'study', chunk_size: int = 500,
+                                      manifest_path: str = None, index: DicomIndex = None) -> pd.DataFrame:
+        """
+        Anonymizes DICOM files in place using a pool of worker processes.
+
+        Unlike `anonymise_dicom_tags`, errors do not stop the run: they are collected
+        from all workers and reported in the returned summary.
+
+        Args:
+            anon_dir (str): Path to the directory containing anonymized DICOM files.
+            df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            n_workers (int): Number of worker processes (defaults to the CPU count).
+            split_by (str): 'study' for one batch per study, 'chunk' for batches of `chunk_size` files.
+            chunk_size (int): Number of files per batch when splitting by chunk.
+            manifest_path (str): If given, files already anonymized according to this job manifest are skipped.
+            index (DicomIndex): Index of the source tree copied to `anon_dir`, used instead of walking it.
+
+        Returns:
+            pd.DataFrame: Per-file summary with FilePath, AnonID, OutputPath, status and error columns.
+        """
+        tasks = list(self._iter_study_files(anon_dir, df, index))
+        return self._run_tasks(tasks, n_workers, split_by, chunk_size, manifest_path)
+
+    def copy_and_anonymise(self, source_dir: str, anon_dir: str, df: pd.DataFrame, n_workers: int = 1,
+                           split_by: str = 'study', chunk_size: int = 500,
+                           manifest_path: str = None, index: DicomIndex = None) -> pd.DataFrame:
+        """
+        Single-pass alternative to `copy_directory`, `rename_mainfolders` and `anonymise_dicom_tags`.
+
+        Each source file is read once, anonymized in memory and written straight to
+        `<AnonID>_<formatted_date>/...` in `anon_dir`. Non-DICOM files are copied unchanged.
+        Only the studies listed in `df` are written.
+
+        Args:
+            source_dir (str): Path to the directory containing the original studies.
+            anon_dir (str): Path to the destination directory for anonymized studies.
+            df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            n_workers (int): Number of worker processes (1 = run in this process).
+            split_by (str): 'study' for one batch per study, 'chunk' for batches of `chunk_size` files.
+            chunk_size (int): Number of files per batch when splitting by chunk.
+            manifest_path (str): If given, only source files that are new, changed or failed
+                according to this job manifest are processed.
+            index (DicomIndex): Index of `source_dir`, used instead of walking the studies.
+
+        Returns:
+            pd.DataFrame: Per-file summary with FilePath, AnonID, OutputPath, status and error columns.
+        """
+        os.makedirs(anon_dir, exist_ok=True)
+        tasks = list(self._iter_source_files(source_dir, anon_dir, df, index))
+        return self._run_tasks(tasks, n_workers, split_by, chunk_size, manifest_path)
+
+    def anonymise_zips(self, source_dir: str, anon_dir: str, df: pd.DataFrame, n_workers: int = 1,
+                       manifest_path: str = None) -> pd.DataFrame:
+        """
+        Streams zipped studies into anonymized zips without extracting them to disk.
+
+        DICOM members of `<StudyDirName>.zip` in `source_dir` are read straight from the archive,
+        anonymized in memory and written to `<AnonID>_<formatted_date>.zip` in `anon_dir`,
+        replacing the unzip -> copy -> anonymise -> zip sequence.
+        Use with metadata from `MetadataExtraction.extract_metadata_from_zips`.
+
+        Args:
+            source_dir (str): Path to the directory containing the study zips.
+            anon_dir (str): Path to the destination directory for the anonymized zips.
+            df (pd.DataFrame): DataFrame containing metadata and anonymization mappings.
+            n_workers (int): Number of worker processes (1 = run in this process), one zip per task.
+            manifest_path (str): If given, only source zips that are new, changed, or had a failed
+                member according to this job manifest (one row per zip) are anonymized again.
+
+        Returns:
+            pd.DataFrame: Per-member summary with FilePath, AnonID, OutputPath, status and error columns.
+        """
+        os.makedirs(anon_dir, exist_ok=True)
+        tasks = []
+        for _, row in df.iterrows():
+            zip_path = os.path.join(source_dir, f"{os.path.basename(str(row['StudyDirName']))}.zip")
+            if not os.path.exists(zip_path):
+                print(f"Warning: Zip not found: {zip_path}")
+                continue
+            output_zip = os.path.join(anon_dir, f"{row['AnonID']}_{row['formatted_date']}.zip")
+            tasks.append((zip_path, str(row['AnonID']), output_zip))
+        return self._run_tasks(tasks, n_workers, 'chunk', 1, manifest_path, worker=_anonymise_zip_batch,
+                               stage_name='anonymise_zips', manifest_rows=_zip_manifest_rows)
+
+
+def _anonymise_zip_batch(anonymiser: Anonymisation, batch: List, fingerprint: bool = False) -> List[Dict]:
+    """
+    Worker entry point: anonymizes a batch of (zip path, AnonID, output zip) tasks.
+
+    With `fingerprint`, each member result also gets the size, mtime and content hash of
+    its source zip (as `zip_fingerprint`), for the job manifest.
+    """
+    results = []
+    for zip_path, anon_id, output_zip in batch:
+        zip_fingerprint = None
+        if fingerprint:
+            try:
+                zip_fingerprint = file_fingerprint(zip_path)
+            except OSError:
+                pass  # Reported by _anonymise_zip, which cannot open it either
+        for result in anonymiser._anonymise_zip(zip_path, anon_id, output_zip):
+            result['zip_fingerprint'] = zip_fingerprint
+            results.append(result)
+    anonymiser.flush()
+    return results
+
+
+def _zip_manifest_rows(batch: List, results: List[Dict]) -> List[Dict]:
+    """
+    Job manifest rows of a batch of zip tasks, one per source zip: done only if none of its
+    members failed (a failed member is left out of the output zip, so the zip is redone).
+    """
+    rows = []
+    for zip_path, anon_id, output_zip in batch:
+        members = [r for r in results if r['FilePath'] == zip_path or r['FilePath'].startswith(zip_path + os.sep)]
+        errors = [f"{r['FilePath']}: {r['error']}" for r in members if r['status'] == 'error']
+        zip_fingerprint = next((r['zip_fingerprint'] for r in members if r.get('zip_fingerprint')), None)
+        size, mtime, content_hash = zip_fingerprint or (None, None, None)
+        rows.append({'FilePath': zip_path, 'AnonID': anon_id, 'OutputPath': output_zip,
+                     'status': 'error' if errors else 'anonymised', 'error': '; '.join(errors),
+                     'size': size, 'mtime': mtime, 'content_hash': content_hash})
+    return rows
+
+
+def _anonymise_file_batch(anonymiser: Anonymisation, batch: List, fingerprint: bool = False) -> List[Dict]:
+    """
+    Worker entry point: anonymizes a batch of (file path, AnonID, output path) tasks.
+
+    With `fingerprint`, each successful result also gets the size, mtime and content hash
+    of its file path after processing, for the job manifest.
+    """
+    results = []
+    for result in anonymiser._anonymise_files(batch):
+        if fingerprint and result['status'] != 'error':
+            try:
+                result['size'], result['mtime'], result['content_hash'] = file_fingerprint(result['FilePath'])
+            except OSError as e:
+                result['status'] = 'error'
+                result['error'] = str(e)
+        results.append(result)
+    anonymiser.flush()
+    return results
@@ -0,0 +1,80 @@
+"""
+Benchmark: full `pydicom.dcmread` vs header-only reads on enhanced MR files.
+
+Writes a few synthetic multi-megabyte enhanced MR files to a temporary directory and
+reports, per read mode, the mean latency and the number of bytes pulled from disk.
+
+Usage:
+    python benchmarks/bench_header_reads.py [--files 5] [--frames 60] [--size 256]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dicom_io import read_dicom_header  # noqa: E402
+from synthetic import make_enhanced_mr  # noqa: E402
+
+
+class CountingFile(io.FileIO):
+    """Unbuffered file that counts the bytes read through it."""
+
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        n = super().readinto(buffer)
+        self.bytes_read += n or 0
+        return n
+
+
+READ_MODES = {
+    'full': lambda f: pydicom.dcmread(f),
+    'header': lambda f: read_dicom_header(f),
+    'tags': lambda f: read_dicom_header(f, specific_tags=['PatientID']),
+}
+
+
+def run(n_files: int, n_frames: int, size: int, repeats: int = 3):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(tmp, f'enhanced_{i}.dcm')
+            make_enhanced_mr(path, f'MRN{i:05d}', n_frames=n_frames, rows=size, columns=size, seed=i)
+            paths.append(path)
+        file_mb = sum(os.path.getsize(p) for p in paths) / n_files / 1e6
+        print(f"{n_files} files, {file_mb:.1f} MB each")
+        print(f"{'mode':<8}{'ms/file':>10}{'KB read/file':>15}")
+
+        for mode, read in READ_MODES.items():
+            bytes_read = 0
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for path in paths:
+                    with CountingFile(path) as f:
+                        read(f)
+                        bytes_read += f.bytes_read
+            elapsed = time.perf_counter() - start
+            n_reads = repeats * n_files
+            print(f"{mode:<8}{1000 * elapsed / n_reads:>10.2f}{bytes_read / n_reads / 1024:>15.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--size', type=int, default=256)
+    args = parser.parse_args()
+    run(args.files, args.frames, args.size)
@@ -0,0 +1,75 @@
+"""
+Benchmark: sequential vs thread-pooled header reads under simulated network latency.
+
+Files are opened through `DelayedFile`, a local stand-in for an SMB share that sleeps
+for a fixed latency on open and on every read call, like a network round trip.
+The same headers are then read one at a time and with `dicom_io.thread_map` at
+several in-flight counts.
+
+Usage:
+    python benchmarks/bench_network_reads.py [--files 200] [--latency-ms 5] [--in-flight 1 4 16 32]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dicom_io import read_dicom_header, thread_map  # noqa: E402
+from synthetic import make_mr_slice  # noqa: E402
+
+
+class DelayedFile(io.FileIO):
+    """Local file that waits `latency` seconds on open and on every read, like a remote share."""
+
+    def __init__(self, path, latency: float):
+        time.sleep(latency)
+        super().__init__(path, 'rb')
+        self.latency = latency
+
+    def read(self, size=-1):
+        time.sleep(self.latency)
+        return super().read(size)
+
+    def readinto(self, buffer):
+        time.sleep(self.latency)
+        return super().readinto(buffer)
+
+
+def run(n_files: int, latency_ms: float, in_flight_counts):
+    latency = latency_ms / 1000
+
+    def read(path):
+        # Buffered like a normal open(), so latency is paid per buffer fill rather than per tiny read
+        with io.BufferedReader(DelayedFile(path, latency), buffer_size=64 * 1024) as f:
+            return read_dicom_header(f).PatientID
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(tmp, f'IM{i:05d}.dcm')
+            make_mr_slice(path, f'MRN{i % 10:05d}', '1.2.3', '1.2.3.4', instance_number=i, rows=128, columns=128)
+            paths.append(path)
+
+        print(f"{n_files} files, {latency_ms:g} ms simulated latency per open/read")
+        print(f"{'in flight':>10}{'files/s':>10}{'speed-up':>10}")
+        baseline = None
+        for max_in_flight in in_flight_counts:
+            start = time.perf_counter()
+            patient_ids = list(thread_map(read, paths, max_in_flight))
+            elapsed = time.perf_counter() - start
+            assert patient_ids == [f'MRN{i % 10:05d}' for i in range(n_files)]  # Results stay in order
+            baseline = baseline or elapsed
+            print(f"{max_in_flight:>10}{n_files / elapsed:>10.1f}{baseline / elapsed:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4, 16, 32])
+    args = parser.parse_args()
+    run(args.files, args.latency_ms, args.in_flight)
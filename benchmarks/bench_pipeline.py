@@ -0,0 +1,273 @@
+"""
+Benchmark harness for the stages of `main.py` on a synthetic cohort.
+
+Generates a cohort (unzipped and zipped layouts) with `synthetic.make_cohort`, then times
+each stage separately in a fresh process so its peak RSS can be measured on its own:
+extract_metadata, copy_directory, rename_mainfolders, anonymise_dicom_tags,
+create_anon_keys and zip_folder_handler, plus the optional single-pass, parallel,
+zip-to-zip and bulk zip (`zip_bulk.zip_folders`) modes. Results (files/s, MB/s, peak RSS) are printed and saved as JSON;
+pass `--compare` with an earlier JSON file to see the speed-up per stage.
+
+Usage:
+    python benchmarks/bench_pipeline.py --studies 5 --series 4 --slices 30 --output bench.json
+    python benchmarks/bench_pipeline.py --stages extract_metadata copy_and_anonymise --compare bench.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+import pydicom
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from anonymise_dicoms import MetadataExtraction, Anonymisation  # noqa: E402
+from create_simple_keys import create_anon_keys  # noqa: E402
+from unzip import ZipFolderHandler  # noqa: E402
+from synthetic import make_cohort  # noqa: E402
+from zip_bulk import zip_folders  # noqa: E402
+
+DEFAULT_STAGES = ['extract_metadata', 'copy_directory', 'rename_mainfolders', 'anonymise_dicom_tags',
+                  'create_anon_keys', 'zip_folder_handler']
+OPTIONAL_STAGES = ['copy_and_anonymise', 'anonymise_dicom_tags_parallel', 'anonymise_zips', 'zip_folders']
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (or its largest child), in MB, if it can be measured."""
+    try:
+        import resource
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform == 'darwin':
+            return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children) / (1024 * 1024)  # Bytes
+        # On Linux ru_maxrss (KB) carries over the parent's peak through fork + exec, VmHWM does not
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        return max(own, children) / 1024
+    except (ImportError, OSError, StopIteration):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)  # Windows
+    except (ImportError, AttributeError):
+        return None
+
+
+def _metadata(ctx):
+    return pd.read_pickle(ctx['metadata'])
+
+
+# Each stage does its setup and returns the callable that is timed
+def _extract_metadata(ctx):
+    keys = pd.read_csv(ctx['keys_csv'], dtype=str)
+
+    def run():
+        df = MetadataExtraction(ctx['src']).extract_metadata(set(keys['mrn']))
+        df['AnonID'] = df['mrn'].map(keys.set_index('mrn')['AnonID'])
+        df.to_pickle(ctx['metadata'])
+    return run
+
+
+def _copy_directory(ctx):
+    return lambda: Anonymisation().copy_directory(ctx['src'], ctx['anon'])
+
+
+def _rename_mainfolders(ctx):
+    df = _metadata(ctx)
+    return lambda: Anonymisation().rename_mainfolders(ctx['anon'], df)
+
+
+def _anonymiser(ctx):
+    if ctx['queue_size'] is None:
+        return Anonymisation()
+    return Anonymisation(read_queue_size=ctx['queue_size'], write_queue_size=ctx['queue_size'])
+
+
+def _anonymise_dicom_tags(ctx):
+    df = _metadata(ctx)
+    return lambda: _anonymiser(ctx).anonymise_dicom_tags(ctx['anon'], df)
+
+
+def _anonymise_dicom_tags_parallel(ctx):
+    df = _metadata(ctx)
+    return lambda: _anonymiser(ctx).anonymise_dicom_tags_parallel(ctx['anon'], df, n_workers=ctx['n_workers'])
+
+
+def _copy_and_anonymise(ctx):
+    df = _metadata(ctx)
+    return lambda: _anonymiser(ctx).copy_and_anonymise(ctx['src'], ctx['anon_single_pass'], df,
+                                                       n_workers=ctx['n_workers'])
+
+
+def _anonymise_zips(ctx):
+    df = _metadata(ctx)
+    return lambda: Anonymisation().anonymise_zips(ctx['zipped'], ctx['anon_zips'], df, n_workers=ctx['n_workers'])
+
+
+def _create_anon_keys(ctx):
+    return lambda: create_anon_keys(ctx['zipped'], os.path.join(ctx['work'], 'simple_keys.csv'))
+
+
+def _zip_folder_handler(ctx):
+    handler = ZipFolderHandler(ctx['zipped'], ctx['unzipped'], n_workers=ctx['n_workers'])
+    return handler.process_all_zipped_folders
+
+
+def _zip_folders(ctx):
+    return lambda: zip_folders(ctx['src'], ctx['rezipped'], n_workers=ctx['n_workers'])
+
+
+STAGES = {
+    'extract_metadata': _extract_metadata,
+    'copy_directory': _copy_directory,
+    'rename_mainfolders': _rename_mainfolders,
+    'anonymise_dicom_tags': _anonymise_dicom_tags,
+    'create_anon_keys': _create_anon_keys,
+    'zip_folder_handler': _zip_folder_handler,
+    'copy_and_anonymise': _copy_and_anonymise,
+    'anonymise_dicom_tags_parallel': _anonymise_dicom_tags_parallel,
+    'anonymise_zips': _anonymise_zips,
+    'zip_folders': _zip_folders,
+}
+
+
+def _stage_worker(name, ctx, queue):
+    """Runs one stage in a fresh process, with its console output discarded."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                run = STAGES[name](ctx)
+                start = time.perf_counter()
+                run()
+                seconds = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+        queue.put({'seconds': seconds, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def _tree_size(root):
+    n_files, n_bytes = 0, 0
+    for dir_path, _, files in os.walk(root):
+        for file in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(dir_path, file))
+    return n_files, n_bytes
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work:
+        ctx = {
+            'work': work,
+            'src': os.path.join(work, 'original'),
+            'zipped': os.path.join(work, 'zipped'),
+            'unzipped': os.path.join(work, 'unzipped'),
+            'anon': os.path.join(work, 'anonymised'),
+            'anon_single_pass': os.path.join(work, 'anonymised_single_pass'),
+            'anon_zips': os.path.join(work, 'anonymised_zips'),
+            'rezipped': os.path.join(work, 'rezipped'),
+            'metadata': os.path.join(work, 'metadata.pkl'),
+            'keys_csv': os.path.join(work, 'keys.csv'),
+            'n_workers': args.workers,
+            'queue_size': args.queue_size,
+        }
+        cohort_args = dict(n_studies=args.studies, n_series=args.series, n_slices=args.slices,
+                           rows=args.size, columns=args.size, enhanced=args.enhanced)
+        print("Generating synthetic cohort...")
+        keys = make_cohort(ctx['src'], **cohort_args)
+        make_cohort(ctx['zipped'], zipped=True, **cohort_args)
+        pd.DataFrame(keys).to_csv(ctx['keys_csv'], index=False)
+
+        n_files, n_bytes = _tree_size(ctx['src'])
+        zip_files, zip_bytes = _tree_size(ctx['zipped'])
+        first_file_bytes = n_bytes / n_files
+        # (files, bytes) each stage handles
+        volumes = {name: (n_files, n_bytes) for name in STAGES}
+        volumes['extract_metadata'] = (args.studies, int(args.studies * first_file_bytes))
+        volumes['create_anon_keys'] = (zip_files, zip_bytes)
+
+        # Stages that need the metadata (or a renamed copy) get them even if not benchmarked
+        required = set(args.stages)
+        if required - {'extract_metadata', 'copy_directory', 'create_anon_keys', 'zip_folder_handler', 'zip_folders'}:
+            required.add('extract_metadata')
+        if required & {'anonymise_dicom_tags', 'anonymise_dicom_tags_parallel'}:
+            required.update(('copy_directory', 'rename_mainfolders'))
+        stages = [name for name in STAGES if name in required]  # Pipeline order
+
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        print(f"{'stage':<32}{'seconds':>9}{'files/s':>10}{'MB/s':>9}{'peak MB':>9}")
+        for name in stages:
+            queue = context.Queue()
+            process = context.Process(target=_stage_worker, args=(name, ctx, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if 'error' in result:
+                print(f"{name:<32}failed: {result['error']}")
+                results[name] = result
+                continue
+            files, size = volumes[name]
+            result.update(files=files, bytes=size, files_per_s=files / result['seconds'],
+                          mb_per_s=size / 1e6 / result['seconds'])
+            results[name] = result
+            rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] is not None else 'n/a'
+            print(f"{name:<32}{result['seconds']:>9.2f}{result['files_per_s']:>10.1f}"
+                  f"{result['mb_per_s']:>9.1f}{rss:>9}")
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'cohort': {**cohort_args, 'n_files': n_files, 'total_bytes': n_bytes, 'zipped_bytes': zip_bytes},
+        'queue_size': args.queue_size,
+        'n_workers': args.workers,
+        'stages': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.compare:
+        compare(args.compare, report)
+    return report
+
+
+def compare(baseline_path: str, report: dict):
+    """Prints the speed-up of each stage against an earlier JSON report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline['timestamp']})")
+    print(f"{'stage':<32}{'before s':>10}{'after s':>10}{'speed-up':>10}")
+    for name, result in report['stages'].items():
+        before = baseline['stages'].get(name, {})
+        if 'seconds' not in result or 'seconds' not in before:
+            continue
+        print(f"{name:<32}{before['seconds']:>10.2f}{result['seconds']:>10.2f}"
+              f"{before['seconds'] / result['seconds']:>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--studies', type=int, default=5)
+    parser.add_argument('--series', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=30, help="Slices per series (frames if --enhanced)")
+    parser.add_argument('--size', type=int, default=256, help="Rows and columns per slice")
+    parser.add_argument('--enhanced', action='store_true', help="One enhanced multi-frame file per series")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes for the parallel modes")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="Read-ahead and write-behind queue size of the anonymise stages (0 = sequential)")
+    parser.add_argument('--stages', nargs='+', default=DEFAULT_STAGES, choices=DEFAULT_STAGES + OPTIONAL_STAGES)
+    parser.add_argument('--work-dir', default=None, help="Where to generate the cohort (default: system temp)")
+    parser.add_argument('--output', default=None, help="JSON file to save the results to")
+    parser.add_argument('--compare', default=None, help="Earlier JSON results to compare against")
+    run(parser.parse_args())
@@ -0,0 +1,67 @@
+"""
+Benchmark: full rewrite vs header-only rewrite with pixel data pass-through.
+
+Writes one large enhanced multi-frame MR file and anonymizes it both ways
+(`Anonymisation(pixel_passthrough=False)` decodes and re-encodes the whole file with
+`save_as`; the default parses and rewrites only the header and copies the pixel
+data with `dicom_io.copy_tail`). Each mode runs in a fresh process so its peak RSS
+and CPU time are measured on their own. The two outputs are checked to be identical.
+
+Usage:
+    python benchmarks/bench_pixel_passthrough.py [--frames 500] [--size 512] [--repeats 3]
+"""
+
+import argparse
+import filecmp
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from anonymise_dicoms import Anonymisation  # noqa: E402
+from bench_pipeline import peak_rss_mb  # noqa: E402
+from synthetic import make_enhanced_mr  # noqa: E402
+
+
+def _run_mode(passthrough: bool, source: str, output: str, repeats: int, queue):
+    anonymiser = Anonymisation(pixel_passthrough=passthrough)
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(repeats):
+        result = anonymiser._anonymise_file(source, 'A1', output)
+        assert result['status'] == 'anonymised', result['error']
+    queue.put({'wall_s': (time.perf_counter() - wall) / repeats, 'cpu_s': (time.process_time() - cpu) / repeats,
+               'peak_rss_mb': peak_rss_mb()})
+
+
+def run(n_frames: int, size: int, repeats: int):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'enhanced.dcm')
+        make_enhanced_mr(source, 'MRN00001', n_frames=n_frames, rows=size, columns=size)
+        print(f"{n_frames} frames of {size}x{size}: {os.path.getsize(source) / 1e6:.0f} MB, {repeats} repeats")
+        print(f"{'mode':<14}{'wall s':>9}{'CPU s':>9}{'MB/s':>9}{'peak MB':>9}")
+
+        outputs = {}
+        for name, passthrough in (('full rewrite', False), ('passthrough', True)):
+            outputs[name] = os.path.join(tmp, f'{passthrough}.dcm')
+            queue = context.Queue()
+            process = context.Process(target=_run_mode, args=(passthrough, source, outputs[name], repeats, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] is not None else 'n/a'
+            print(f"{name:<14}{result['wall_s']:>9.2f}{result['cpu_s']:>9.2f}"
+                  f"{os.path.getsize(source) / 1e6 / result['wall_s']:>9.0f}{rss:>9}")
+        assert filecmp.cmp(outputs['full rewrite'], outputs['passthrough'], shallow=False)
+        print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--size', type=int, default=512, help="Rows and columns per frame")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    run(args.frames, args.size, args.repeats)
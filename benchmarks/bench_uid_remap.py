@@ -0,0 +1,71 @@
+"""
+Micro-benchmark: hashing every UID occurrence vs the memoised `UIDMap`.
+
+Builds the UID stream of a synthetic cohort (per instance: study, series, frame of
+reference and SOP instance UIDs, plus references to earlier instances of the series)
+and remaps it three ways: `pydicom.uid.generate_uid` per occurrence (how 'hash_uid' used
+to work), `UIDMap` in memory, and `UIDMap` writing to a SQLite UID map. All three must
+give the same UIDs.
+
+Usage:
+    python benchmarks/bench_uid_remap.py [--instances 200000] [--per-series 200] [--references 2]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from pydicom.uid import generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from uid_map import UIDMap  # noqa: E402
+
+SALT = 'benchmark-salt'
+
+
+def cohort_uids(n_instances: int, per_series: int, n_references: int):
+    """UIDs in the order a run meets them, series by series (4 series per study)."""
+    uids = []
+    for i in range(n_instances):
+        series = i // per_series
+        study = series // 4
+        uids += [f'1.2.3.{study}', f'1.2.3.{study}.{series % 4}', f'1.2.3.{study}.99',
+                 f'1.2.3.{study}.{series % 4}.{i}']
+        uids += [f'1.2.3.{study}.{series % 4}.{max(i - r - 1, 0)}' for r in range(n_references)]
+    return uids
+
+
+def run(n_instances: int, per_series: int, n_references: int):
+    uids = cohort_uids(n_instances, per_series, n_references)
+    print(f"{n_instances} instances, {len(uids)} UID occurrences, {len(set(uids))} distinct UIDs")
+    print(f"{'remap':<18}{'s':>8}{'us/UID':>8}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uid_map = UIDMap(SALT, os.path.join(tmp, 'uids.sqlite'))
+        modes = {
+            'generate_uid': lambda uid: generate_uid(entropy_srcs=[SALT, uid]),
+            'UIDMap': UIDMap(SALT).remap,
+            'UIDMap + SQLite': uid_map.remap,
+        }
+        outputs = {}
+        for name, remap in modes.items():
+            start = time.perf_counter()
+            outputs[name] = [remap(uid) for uid in uids]
+            if name == 'UIDMap + SQLite':
+                uid_map.close()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<18}{elapsed:>8.2f}{1e6 * elapsed / len(uids):>8.2f}")
+
+    assert outputs['generate_uid'] == outputs['UIDMap'] == outputs['UIDMap + SQLite']
+    print(f"Same UIDs in all modes; cache hit rate {uid_map.hits / len(uids):.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--instances', type=int, default=200_000)
+    parser.add_argument('--per-series', type=int, default=200)
+    parser.add_argument('--references', type=int, default=2)
+    args = parser.parse_args()
+    run(args.instances, args.per_series, args.references)
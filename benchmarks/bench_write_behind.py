@@ -0,0 +1,79 @@
+"""
+Benchmark: sequential vs pipelined (read-ahead / write-behind) anonymisation.
+
+Anonymizes the same synthetic series with `Anonymisation._anonymise_files` at several
+queue sizes (0 = read, rewrite and write one file at a time). `SlowDiskAnonymisation`
+adds a fixed latency to each file's read and write step, a stand-in for a network share
+or a slow destination drive, as the page cache of a local benchmark hides real disk waits.
+All queue sizes must write identical files.
+
+Usage:
+    python benchmarks/bench_write_behind.py [--files 200] [--latency-ms 5] [--queue-sizes 0 1 4 16]
+"""
+
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from anonymise_dicoms import Anonymisation  # noqa: E402
+from synthetic import make_mr_slice  # noqa: E402
+
+
+class SlowDiskAnonymisation(Anonymisation):
+    """`Anonymisation` that sleeps `latency` seconds in every read and write step (releasing the GIL, as I/O does)."""
+
+    def __init__(self, latency: float, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def _read_step(self, *task):
+        time.sleep(self.latency)
+        return super()._read_step(*task)
+
+    def _write_step(self, item):
+        time.sleep(self.latency)
+        return super()._write_step(item)
+
+
+def run(n_files: int, latency_ms: float, queue_sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(tmp, 'src', f'IM{i:05d}.dcm')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            make_mr_slice(path, 'MRN00001', '1.2.3', '1.2.3.4', instance_number=i, rows=256, columns=256)
+            paths.append(path)
+
+        print(f"{n_files} files, {latency_ms:g} ms simulated latency per read and per write")
+        print(f"{'queue size':<12}{'s':>8}{'files/s':>9}")
+        outputs = {}
+        for queue_size in queue_sizes:
+            out_dir = os.path.join(tmp, f'q{queue_size}')
+            tasks = [(path, 'A1', os.path.join(out_dir, os.path.basename(path))) for path in paths]
+            anonymiser = SlowDiskAnonymisation(latency_ms / 1000, read_queue_size=queue_size,
+                                               write_queue_size=queue_size)
+            start = time.perf_counter()
+            results = list(anonymiser._anonymise_files(tasks))
+            elapsed = time.perf_counter() - start
+            assert all(result['status'] == 'anonymised' for result in results)
+            outputs[queue_size] = out_dir
+            print(f"{queue_size:<12}{elapsed:>8.2f}{n_files / elapsed:>9.0f}")
+
+        first = outputs[queue_sizes[0]]
+        for out_dir in outputs.values():
+            match, mismatch, errors = filecmp.cmpfiles(first, out_dir, os.listdir(first), shallow=False)
+            assert not mismatch and not errors
+        print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--queue-sizes', type=int, nargs='+', default=[0, 1, 4, 16])
+    args = parser.parse_args()
+    run(args.files, args.latency_ms, args.queue_sizes)
@@ -0,0 +1,81 @@
+"""
+Consistency check of the collated metadata store (`collate_metadata.MetadataStore`).
+
+Ingests small metadata CSVs into a temporary store and checks the studies read back:
+a study shared by two projects keeps a row in each, a study repeated within a project
+is kept once (from the CSV ingested first), and changing a CSV that was ingested before
+others of its project and ingesting it again loses no study that a later CSV still lists.
+Reading one project must only open that project's parts. Exits with code 1 on a failure.
+
+Usage:
+    python benchmarks/check_collate_metadata.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import collate_metadata  # noqa: E402
+from collate_metadata import MetadataStore  # noqa: E402
+
+
+def write_csv(path: str, studies):
+    pd.DataFrame({'StudyInstanceUID': [uid for uid, _ in studies],
+                  'AnonID': [anon_id for _, anon_id in studies]}).to_csv(path, index=False)
+    time.sleep(0.01)  # Distinct mtimes, so the ingest order is the order written
+
+
+def studies(store: MetadataStore, project: str):
+    return sorted(zip(*store.read([project])[['StudyInstanceUID', 'AnonID']].values.T))
+
+
+def run() -> bool:
+    failures = []
+
+    def check(name, got, expected):
+        print(f"{name:<45}{'ok' if got == expected else f'FAILED: {got} != {expected}'}")
+        if got != expected:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as work:
+        csv_dir = os.path.join(work, 'metadata')
+        os.makedirs(csv_dir)
+        with MetadataStore(os.path.join(work, 'collated')) as store:
+            write_csv(os.path.join(csv_dir, 'AHCM_a.csv'), [('1.1', 'A1'), ('1.2', 'A2')])
+            write_csv(os.path.join(csv_dir, 'AHCM_topup.csv'), [('1.2', 'A2'), ('1.3', 'A3')])
+            write_csv(os.path.join(csv_dir, 'MAVA_a.csv'), [('1.2', 'M1'), ('1.2', 'M1')])
+            store.ingest_folder(csv_dir)
+            check("duplicates within a project", studies(store, 'AHCM'),
+                  [('1.1', 'A1'), ('1.2', 'A2'), ('1.3', 'A3')])
+            check("study shared with another project", studies(store, 'MAVA'), [('1.2', 'M1')])
+
+            # The changed CSV no longer lists 1.2, which the top-up left out as a duplicate of it
+            write_csv(os.path.join(csv_dir, 'AHCM_a.csv'), [('1.1', 'A1')])
+            store.ingest_folder(csv_dir)
+            check("changed CSV ingested again", studies(store, 'AHCM'),
+                  [('1.1', 'A1'), ('1.2', 'A2'), ('1.3', 'A3')])
+            write_csv(os.path.join(csv_dir, 'AHCM_a.csv'), [('1.1', 'A1'), ('1.3', 'A9')])
+            store.ingest_folder(csv_dir)
+            check("earlier CSV keeps its studies", studies(store, 'AHCM'),
+                  [('1.1', 'A1'), ('1.2', 'A2'), ('1.3', 'A9')])
+
+            opened = []
+            read_schema = collate_metadata.pq.read_schema
+            collate_metadata.pq.read_schema = lambda part: opened.append(part) or read_schema(part)
+            try:
+                store.read(['MAVA'])
+            finally:
+                collate_metadata.pq.read_schema = read_schema
+            check("parts opened to read one project", [os.path.basename(os.path.dirname(part)) for part in opened],
+                  ['project=MAVA'])
+
+    print("Collated metadata store " + ("FAILED" if failures else "consistent"))
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)
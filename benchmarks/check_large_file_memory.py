@@ -0,0 +1,157 @@
+"""
+Memory ceiling check: peak RSS of metadata extraction and anonymisation on a multi-GB file.
+
+Writes a synthetic enhanced multi-frame MR file with `--size-gb` of pixel data (streamed to
+disk with `synthetic.make_large_mr`, so it can be larger than memory), then runs each stage
+on it in a fresh process and measures that process's peak RSS: metadata extraction,
+anonymisation with `pixel_passthrough=False` (large files are passed through regardless),
+anonymisation with content dedup and, with `--zip`, zip-to-zip anonymisation of the file
+zipped. The check fails (exit code 1) if any stage goes over `--max-rss-mb` or if the
+anonymised pixel data differs from the source.
+
+Usage:
+    python benchmarks/check_large_file_memory.py [--size-gb 2.5] [--max-rss-mb 400] [--encapsulated] [--zip]
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from anonymise_dicoms import Anonymisation, MetadataExtraction  # noqa: E402
+from bench_pipeline import peak_rss_mb  # noqa: E402
+from synthetic import make_large_mr  # noqa: E402
+
+STUDY = 'MRN000001'
+
+
+def _metadata(ctx):
+    df = MetadataExtraction(ctx['src']).extract_metadata(None)
+    assert df['mrn'].tolist() == [STUDY]
+
+
+def _anonymise(ctx):
+    anonymiser = Anonymisation(pixel_passthrough=False, large_file_size=ctx['large_file_size'])
+    result = anonymiser._anonymise_file(ctx['file'], 'A1', ctx['output'])
+    assert result['status'] == 'anonymised', result['error']
+
+
+def _anonymise_dedup(ctx):
+    anonymiser = Anonymisation(large_file_size=ctx['large_file_size'], dedup='link')
+    result = anonymiser._anonymise_file(ctx['file'], 'A1', ctx['output_dedup'])
+    assert result['status'] == 'anonymised', result['error']
+
+
+def _anonymise_zip(ctx):
+    anonymiser = Anonymisation(large_file_size=ctx['large_file_size'])
+    results = anonymiser._anonymise_zip(ctx['zip'], 'A1', ctx['output_zip'])
+    assert [result['status'] for result in results] == ['anonymised'], results
+
+
+STAGES = {
+    'metadata': _metadata,
+    'anonymise': _anonymise,
+    'anonymise_dedup': _anonymise_dedup,
+    'anonymise_zip': _anonymise_zip,
+}
+
+
+def _stage_worker(name, ctx, queue):
+    """Runs one stage in a fresh process, with its console output discarded."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                start = time.perf_counter()
+                STAGES[name](ctx)
+                seconds = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+        queue.put({'seconds': seconds, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def pixel_data_digest(source) -> str:
+    """BLAKE2b of everything from the pixel data element to the end of a DICOM file (path or open file)."""
+    with (open(source, 'rb') if isinstance(source, str) else source) as f:
+        pydicom.dcmread(f, stop_before_pixels=True)
+        digest = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run(args) -> bool:
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work:
+        ctx = {
+            'src': os.path.join(work, 'original'),
+            'file': os.path.join(work, 'original', STUDY, 'series_1', 'IM00001.dcm'),
+            'output': os.path.join(work, 'anonymised', 'IM00001.dcm'),
+            'output_dedup': os.path.join(work, 'anonymised_dedup', 'IM00001.dcm'),
+            'zip': os.path.join(work, 'zipped', f'{STUDY}.zip'),
+            'output_zip': os.path.join(work, 'anonymised_zips', 'A1_20250101.zip'),
+            'large_file_size': args.large_file_size_mb * 1024 * 1024,
+        }
+        print(f"Writing a {args.size_gb:g} GB synthetic file...")
+        n_frames = make_large_mr(ctx['file'], STUDY, int(args.size_gb * 1024 ** 3), encapsulated=args.encapsulated)
+        size = os.path.getsize(ctx['file'])
+        print(f"{size / 1e9:.2f} GB, {n_frames} frames, {'encapsulated' if args.encapsulated else 'native'} pixel data")
+        stages = ['metadata', 'anonymise', 'anonymise_dedup']
+        if args.zip:
+            os.makedirs(os.path.dirname(ctx['zip']))
+            with zipfile.ZipFile(ctx['zip'], 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                zf.write(ctx['file'], 'series_1/IM00001.dcm')
+            stages.append('anonymise_zip')
+
+        ok = True
+        context = multiprocessing.get_context('spawn')
+        print(f"{'stage':<20}{'seconds':>9}{'peak MB':>9}")
+        for name in stages:
+            queue = context.Queue()
+            process = context.Process(target=_stage_worker, args=(name, ctx, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if 'error' in result:
+                print(f"{name:<20}failed: {result['error']}")
+                ok = False
+                continue
+            rss = result['peak_rss_mb']
+            over = rss is not None and rss > args.max_rss_mb
+            ok &= not over
+            print(f"{name:<20}{result['seconds']:>9.1f}{rss if rss is not None else float('nan'):>9.0f}"
+                  f"{'  over the ceiling' if over else ''}")
+
+        source_digest = pixel_data_digest(ctx['file'])
+        outputs = [ctx['output'], ctx['output_dedup']]
+        for output in outputs:
+            if os.path.exists(output) and pixel_data_digest(output) != source_digest:
+                print(f"Pixel data of {output} differs from the source")
+                ok = False
+        if os.path.exists(ctx['output_zip']):
+            with zipfile.ZipFile(ctx['output_zip']) as zf:
+                if pixel_data_digest(zf.open(zf.infolist()[0])) != source_digest:
+                    print("Pixel data in the anonymised zip differs from the source")
+                    ok = False
+    print(f"Memory ceiling of {args.max_rss_mb} MB {'held' if ok else 'NOT held'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-gb', type=float, default=2.5, help="Pixel data size of the synthetic file")
+    parser.add_argument('--max-rss-mb', type=float, default=400, help="Peak RSS allowed per stage")
+    parser.add_argument('--large-file-size-mb', type=int, default=256, help="Anonymisation large_file_size")
+    parser.add_argument('--encapsulated', action='store_true',
+                        help="Encapsulated (compressed-like) pixel data, which also allows files over 4 GB")
+    parser.add_argument('--zip', action='store_true', help="Also check zip-to-zip anonymisation")
+    parser.add_argument('--work-dir', default=None, help="Where to write the temporary files")
+    sys.exit(0 if run(parser.parse_args()) else 1)
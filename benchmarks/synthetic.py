@@ -0,0 +1,231 @@
+"""
+Synthetic DICOM files for benchmarking, written with pydicom.
+
+The files mimic what we get from the scanners: identifying tags at the top level,
+PatientID repeated inside nested sequences, and (for enhanced MR) per-frame
+functional group sequences in front of a large PixelData element.
+"""
+
+import os
+import shutil
+import struct
+import zipfile
+from typing import Dict, List
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import (ExplicitVRLittleEndian, JPEG2000Lossless, generate_uid, MRImageStorage,
+                         EnhancedMRImageStorage)
+
+
+def _base_dataset(sop_class_uid: str, patient_id: str, study_uid: str, series_uid: str,
+                  study_date: str) -> Dataset:
+    """Builds the patient/study/series header shared by all synthetic files."""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.FrameOfReferenceUID = generate_uid()
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'SIEMENS'
+    ds.ManufacturerModelName = 'Avanto'
+    ds.DeviceSerialNumber = '42110'
+    ds.InstitutionName = 'Synthetic Hospital'
+    ds.InstitutionAddress = '1 Example Road'
+    ds.ReferringPhysicianName = 'Ref^Doctor'
+    ds.OperatorsName = 'Op^Erator'
+    ds.PatientName = f'Patient^{patient_id}'
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = '19700101'
+    ds.PatientSex = 'F'
+    ds.PatientSize = 1.7
+    ds.PatientWeight = 70
+    ds.StudyDate = study_date
+    ds.StudyTime = '093000'
+    ds.StudyID = '1'
+    ds.SeriesDescription = 'cine_sax'
+    ds.ProtocolName = 'cine_sax'
+
+    # PatientID repeated in nested sequences, as in the scanner exports
+    referenced_patient = Dataset()
+    referenced_patient.PatientID = patient_id
+    referenced_patient.ReferencedSOPClassUID = sop_class_uid
+    referenced_patient.ReferencedSOPInstanceUID = generate_uid()
+    ds.ReferencedPatientSequence = Sequence([referenced_patient])
+    other_id = Dataset()
+    other_id.PatientID = patient_id
+    other_id.IssuerOfPatientID = 'HOSP'
+    ds.OtherPatientIDsSequence = Sequence([other_id])
+    return ds
+
+
+def _set_image_pixel_module(ds: Dataset, rows: int, columns: int):
+    """Sets the attributes describing 12-bit MONOCHROME2 pixel data."""
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+
+
+def _add_pixels(ds: Dataset, rows: int, columns: int, n_frames: int, rng: np.random.Generator):
+    """Adds random 12-bit MONOCHROME2 pixel data."""
+    _set_image_pixel_module(ds, rows, columns)
+    ds.PixelData = rng.integers(0, 4096, size=n_frames * rows * columns, dtype=np.uint16).tobytes()
+
+
+def make_mr_slice(path: str, patient_id: str, study_uid: str, series_uid: str, instance_number: int = 1,
+                  rows: int = 256, columns: int = 256, study_date: str = '20250101', seed: int = 0):
+    """Writes a single-frame MR image to `path`."""
+    ds = _base_dataset(MRImageStorage, patient_id, study_uid, series_uid, study_date)
+    ds.InstanceNumber = instance_number
+    ds.SliceLocation = float(instance_number)
+    _add_pixels(ds, rows, columns, 1, np.random.default_rng(seed))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def _enhanced_dataset(patient_id: str, study_uid: str, series_uid: str, n_frames: int, nesting_depth: int,
+                      study_date: str) -> Dataset:
+    """Builds the header of an enhanced multi-frame MR image, without pixel data."""
+    ds = _base_dataset(EnhancedMRImageStorage, patient_id, study_uid or generate_uid(),
+                       series_uid or generate_uid(), study_date)
+    ds.InstanceNumber = 1
+    ds.NumberOfFrames = n_frames
+
+    shared = Dataset()
+    measures = Dataset()
+    measures.PixelSpacing = [1.5, 1.5]
+    measures.SliceThickness = 8.0
+    shared.PixelMeasuresSequence = Sequence([measures])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    per_frame = []
+    for frame in range(n_frames):
+        item = Dataset()
+        content = Dataset()
+        content.FrameAcquisitionNumber = frame
+        content.InStackPositionNumber = frame + 1
+        item.FrameContentSequence = Sequence([content])
+        position = Dataset()
+        position.ImagePositionPatient = [0.0, 0.0, float(frame)]
+        item.PlanePositionSequence = Sequence([position])
+
+        innermost = Dataset()
+        innermost.PatientID = patient_id
+        innermost.ReferencedSOPInstanceUID = generate_uid()
+        for _ in range(nesting_depth):
+            outer = Dataset()
+            outer.ReferencedImageSequence = Sequence([innermost])
+            innermost = outer
+        item.DerivationImageSequence = innermost.ReferencedImageSequence
+        per_frame.append(item)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+    return ds
+
+
+def make_enhanced_mr(path: str, patient_id: str, study_uid: str = None, series_uid: str = None,
+                     n_frames: int = 50, rows: int = 256, columns: int = 256, nesting_depth: int = 3,
+                     study_date: str = '20250101', seed: int = 0):
+    """
+    Writes an enhanced multi-frame MR image to `path`.
+
+    Each frame gets its own functional group item, and every item carries a chain of
+    `nesting_depth` nested referenced-image sequences with PatientID at the bottom,
+    so the file has a deep header as well as `n_frames * rows * columns * 2` bytes of pixels.
+    """
+    ds = _enhanced_dataset(patient_id, study_uid, series_uid, n_frames, nesting_depth, study_date)
+    _add_pixels(ds, rows, columns, n_frames, np.random.default_rng(seed))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def make_large_mr(path: str, patient_id: str, n_bytes: int, rows: int = 512, columns: int = 512,
+                  encapsulated: bool = False, study_date: str = '20250101', seed: int = 0) -> int:
+    """
+    Writes an enhanced multi-frame MR image with about `n_bytes` of pixel data to `path`, like
+    the multi-GB 4D flow files of some cohorts.
+
+    The pixel data is streamed to disk one frame at a time, so files larger than memory can
+    be made. Native pixel data is limited to 4 GB by its 32-bit length; `encapsulated` writes
+    one fragment per frame (undefined length, as compressed pixel data is stored) instead.
+
+    Returns:
+        int: Number of frames.
+    """
+    frame = np.random.default_rng(seed).integers(0, 4096, size=rows * columns, dtype=np.uint16).tobytes()
+    n_frames = max(1, n_bytes // len(frame))
+    if not encapsulated and n_frames * len(frame) >= 0xFFFFFFFF:
+        raise ValueError("Native pixel data is limited to 4 GB, use encapsulated=True")
+    ds = _enhanced_dataset(patient_id, generate_uid(), generate_uid(), n_frames, 1, study_date)
+    _set_image_pixel_module(ds, rows, columns)
+    if encapsulated:
+        ds.file_meta.TransferSyntaxUID = JPEG2000Lossless  # Frames are not really JPEG 2000, nothing decodes them
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+    with open(path, 'ab') as f:
+        if encapsulated:
+            f.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OB', 0, 0xFFFFFFFF))
+            f.write(struct.pack('<HHI', 0xFFFE, 0xE000, 0))  # Empty basic offset table
+            for _ in range(n_frames):
+                f.write(struct.pack('<HHI', 0xFFFE, 0xE000, len(frame)))
+                f.write(frame)
+            f.write(struct.pack('<HHI', 0xFFFE, 0xE0DD, 0))  # Sequence delimiter
+        else:
+            f.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, n_frames * len(frame)))
+            for _ in range(n_frames):
+                f.write(frame)
+    return n_frames
+
+
+def make_cohort(root: str, n_studies: int = 3, n_series: int = 4, n_slices: int = 20, rows: int = 256,
+                columns: int = 256, enhanced: bool = False, zipped: bool = False) -> List[Dict]:
+    """
+    Writes a synthetic cohort under `root`, one study per patient.
+
+    Unzipped layout: `<root>/<MRN>/series_<n>/IM<n>.dcm`. Zipped layout: `<root>/<MRN>.zip`
+    with the same series folders inside, as exported from PACS. With `enhanced`, each series
+    is a single enhanced multi-frame file of `n_slices` frames instead of one file per slice.
+
+    Returns:
+        List[Dict]: One {'mrn', 'AnonID'} key per study.
+    """
+    os.makedirs(root, exist_ok=True)
+    keys = []
+    for study in range(n_studies):
+        mrn = f'MRN{study:06d}'
+        keys.append({'mrn': mrn, 'AnonID': f'A{study + 1}'})
+        study_uid = generate_uid()
+        study_date = f'2025{1 + study % 12:02d}{1 + study % 28:02d}'
+        study_dir = os.path.join(root, mrn)
+        for series in range(n_series):
+            series_dir = os.path.join(study_dir, f'series_{series}')
+            series_uid = generate_uid()
+            if enhanced:
+                make_enhanced_mr(os.path.join(series_dir, 'IM0001.dcm'), mrn, study_uid, series_uid,
+                                 n_frames=n_slices, rows=rows, columns=columns, study_date=study_date, seed=series)
+                continue
+            for instance in range(n_slices):
+                make_mr_slice(os.path.join(series_dir, f'IM{instance + 1:04d}.dcm'), mrn, study_uid, series_uid,
+                              instance_number=instance + 1, rows=rows, columns=columns, study_date=study_date,
+                              seed=instance)
+        if zipped:
+            with zipfile.ZipFile(study_dir + '.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+                for dir_path, _, files in os.walk(study_dir):
+                    for file in sorted(files):
+                        path = os.path.join(dir_path, file)
+                        zf.write(path, os.path.relpath(path, study_dir))
+            shutil.rmtree(study_dir)
+    return keys
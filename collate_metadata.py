@@ -1,21 +1,301 @@
-"""Concise script to collate extracted metadata during the anonymisation process
-for use in the analysis pipeline. """
+"""
+Collates the extracted metadata CSVs of all projects into one columnar store, for use in
+the analysis pipeline.
 
+The store is a folder of Parquet files partitioned by project
+(`<store>/project=<name>/<csv name>.parquet`), one file per ingested CSV, deduplicated on
+StudyInstanceUID within each project: a study already in the project (from an earlier CSV)
+is not added again, while a study shared with another project keeps a row (and AnonID) in each.
+A small SQLite ledger in the store records which CSVs were ingested, in order, with their
+size and mtime, so each run only reads new or changed CSVs. A changed CSV replaces its own
+rows and keeps its place in the ingest order; the CSVs of its project ingested after it are
+ingested again, so studies they left out as duplicates of its old rows are not lost.
+CSVs are read in chunks and written as row groups, so memory stays bounded. Reading one
+project only opens that project's folder.
+
+Usage:
+    python collate_metadata.py ingest metadata --store metadata/collated [--pattern "*mava*.csv"] [--project mavacamten]
+    python collate_metadata.py export --store metadata/collated --output collated.csv [--projects mavacamten]
+
+Requires `pyarrow`.
+"""
+
+import argparse
+import fnmatch
+import hashlib
 import os
+import re
+import sqlite3
+from typing import Dict, List
+
+import numpy as np
 import pandas as pd
 
-folder_name = 'metadata'
-name_component = 'mava'
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the columnar store
+    pa = pads = pq = None
+
+KEY_COLUMN = 'StudyInstanceUID'
+# Per-shard CSVs of sharded runs are merged into the run's CSV, which is the one collated
+SHARD_CSV = re.compile(r'_shard\d{4}\.csv$')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The collated metadata store requires pyarrow: pip install pyarrow")
+
+
+def default_project(csv_path: str) -> str:
+    """Project of a metadata CSV: its name up to the first underscore, e.g. 'AHCM' for AHCM_topup.csv."""
+    return os.path.splitext(os.path.basename(csv_path))[0].split('_')[0]
+
+
+class MetadataStore:
+    """
+    Project-partitioned Parquet store of study metadata, deduplicated within each project.
+
+    Args:
+        store_dir (str): Folder of the store, created if needed.
+        chunk_size (int): Number of CSV rows read and written at a time.
+    """
+
+    def __init__(self, store_dir: str, chunk_size: int = 100_000):
+        _require_pyarrow()
+        self.store_dir = store_dir
+        self.chunk_size = chunk_size
+        os.makedirs(store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(store_dir, '_ingested.sqlite'))
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                csv_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                project TEXT,
+                part_path TEXT,
+                n_rows INTEGER,
+                n_duplicates INTEGER,
+                ingested_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _part_path(self, csv_path: str, project: str) -> str:
+        # The path hash keeps CSVs with the same name in different folders apart
+        digest = hashlib.blake2b(os.path.abspath(csv_path).encode('utf-8'), digest_size=4).hexdigest()
+        stem = os.path.splitext(os.path.basename(csv_path))[0]
+        return os.path.join(self.store_dir, f'project={project}', f'{stem}-{digest}.parquet')
+
+    def _parts(self, project: str = None) -> List[str]:
+        """Parts of the store, or only those of `project`."""
+        query = "SELECT part_path FROM sources WHERE part_path IS NOT NULL"
+        rows = (self.conn.execute(query) if project is None
+                else self.conn.execute(query + " AND project = ?", (project,)))
+        # Kept relative to the store in the ledger, so the store can be moved or opened from anywhere
+        return [os.path.join(self.store_dir, row[0]) for row in rows]
+
+    def _stored_keys(self, project: str, exclude: str = None) -> set:
+        """
+        StudyInstanceUIDs already in `project` (read from the key column only), except those of part `exclude`.
+        """
+        keys = set()
+        for part in self._parts(project):
+            if part != exclude and os.path.exists(part):
+                column = pq.read_table(part, columns=[KEY_COLUMN])[KEY_COLUMN]
+                keys.update(column.drop_null().to_pylist())
+        return keys
+
+    def pending(self, csv_paths: List[str]) -> List[str]:
+        """Filters CSV paths down to those that are new or changed since they were ingested."""
+        ingested = {row[0]: row[1:] for row in self.conn.execute("SELECT csv_path, size, mtime FROM sources")}
+        pending = []
+        for csv_path in csv_paths:
+            stat = os.stat(csv_path)
+            if ingested.get(os.path.abspath(csv_path)) != (stat.st_size, stat.st_mtime):
+                pending.append(csv_path)
+        return pending
+
+    def _remove_part(self, part_path: str):
+        if part_path and os.path.exists(os.path.join(self.store_dir, part_path)):
+            os.remove(os.path.join(self.store_dir, part_path))
+
+    def ingest(self, csv_path: str, project: str = None) -> Dict:
+        """
+        Adds one metadata CSV to the store, in `project` (defaults to `default_project`).
+
+        Rows whose StudyInstanceUID is already in the project (from a CSV ingested earlier), or
+        earlier in the CSV, are skipped; rows without a StudyInstanceUID are kept as they are.
+        The same study in another project is kept.
+
+        A CSV ingested before is replaced in its place in the ingest order: the CSVs of its project
+        (old and new, if it changed) ingested after it are ingested again after it, as the rows
+        they left out as duplicates may no longer be in it.
+
+        Returns:
+            Dict: csv_path, project, rows written and duplicates skipped.
+        """
+        project = project or default_project(csv_path)
+        csv_key = os.path.abspath(csv_path)
+        previous = self.conn.execute("SELECT rowid, project, part_path FROM sources WHERE csv_path = ?",
+                                     (csv_key,)).fetchone()
+        if previous is None:
+            return self._ingest(csv_path, project)
+
+        order, previous_project, previous_part = previous
+        later = []
+        for row in self.conn.execute("SELECT csv_path, project, part_path FROM sources WHERE rowid > ? "
+                                     "AND project IN (?, ?) ORDER BY rowid", (order, project, previous_project)):
+            if os.path.exists(row[0]):
+                later.append(row)
+            else:
+                print(f"Keeping the rows of {row[0]} as they are: the CSV no longer exists")
+        self._remove_part(previous_part)
+        for _, _, later_part in later:
+            self._remove_part(later_part)
+        result = self._ingest(csv_path, project)
+        for later_path, later_project, _ in later:
+            self._ingest(later_path, later_project)
+        if later:
+            print(f"Ingested {len(later)} later CSVs of project {project} again after {csv_path}")
+        return result
+
+    def _ingest(self, csv_path: str, project: str) -> Dict:
+        """Writes the part of one CSV, deduplicated against the other parts of its project, and records it."""
+        csv_key = os.path.abspath(csv_path)
+        stat = os.stat(csv_path)
+        part_path = self._part_path(csv_path, project)
+        seen = self._stored_keys(project, exclude=part_path)
+
+        n_rows = n_duplicates = 0
+        writer = None
+        try:
+            for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=self.chunk_size):
+                if KEY_COLUMN not in chunk.columns:
+                    print(f"Skipping {csv_path}: no {KEY_COLUMN} column")
+                    project = None  # Recorded so it is not read again, but in no project
+                    break
+                keys = chunk[KEY_COLUMN].str.strip()
+                has_key = ~keys.isin(['', 'NA'])
+                # Set lookups rather than Series.isin, which is slow against a large set of Arrow strings
+                stored = np.fromiter((key in seen for key in keys), dtype=bool, count=len(keys))
+                duplicate = has_key & (stored | keys.duplicated())
+                chunk = chunk[~duplicate]
+                seen.update(keys[has_key & ~duplicate])
+                n_duplicates += int(duplicate.sum())
+                if chunk.empty:
+                    continue
+                # All columns as strings, as in the CSVs (MRNs and dates keep their leading zeros)
+                schema = pa.schema([(column, pa.string()) for column in chunk.columns])
+                table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                if writer is None:
+                    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+                    writer = pq.ParquetWriter(part_path + '.part', schema)
+                writer.write_table(table)
+                n_rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(part_path + '.part', part_path)
+        stored_part = os.path.relpath(part_path, self.store_dir) if writer is not None else None
+
+        with self.conn:
+            # Updated rather than replaced, so the CSV keeps its rowid, i.e. its place in the ingest order
+            values = (stat.st_size, stat.st_mtime, project, stored_part, n_rows, n_duplicates, csv_key)
+            updated = self.conn.execute("UPDATE sources SET size = ?, mtime = ?, project = ?, part_path = ?, "
+                                        "n_rows = ?, n_duplicates = ?, ingested_at = CURRENT_TIMESTAMP "
+                                        "WHERE csv_path = ?", values).rowcount
+            if not updated:
+                self.conn.execute("INSERT INTO sources (size, mtime, project, part_path, n_rows, n_duplicates, "
+                                  "csv_path) VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+        return {'csv_path': csv_path, 'project': project, 'rows': n_rows, 'duplicates': n_duplicates}
+
+    def ingest_folder(self, folder: str, pattern: str = '*.csv', project: str = None) -> pd.DataFrame:
+        """
+        Ingests the new or changed CSVs in `folder` whose name matches `pattern`, oldest first
+        (so the first extraction of a study is the one kept).
+
+        Returns:
+            pd.DataFrame: One row per ingested CSV (csv_path, project, rows, duplicates).
+        """
+        csv_paths = [os.path.join(folder, name) for name in os.listdir(folder)
+                     if name.lower().endswith('.csv') and fnmatch.fnmatch(name.lower(), pattern.lower())
+                     and not SHARD_CSV.search(name)]
+        pending = sorted(self.pending(csv_paths), key=os.path.getmtime)
+        print(f"{len(csv_paths)} metadata CSVs, {len(pending)} new or changed")
+        # A CSV may have been ingested again already, after an earlier CSV of its project that changed
+        results = [self.ingest(csv_path, project) for csv_path in pending if self.pending([csv_path])]
+        summary = pd.DataFrame(results, columns=['csv_path', 'project', 'rows', 'duplicates'])
+        if not summary.empty:
+            print(summary.to_string(index=False))
+        return summary
+
+    def dataset(self, projects: List[str] = None):
+        """
+        The store, or only some projects, as a pyarrow dataset with the columns of their CSVs and a
+        `project` partition column. Only the parts of `projects` are opened.
+        """
+        parts = self._parts() if not projects else [part for project in projects for part in self._parts(project)]
+        parts = [part for part in parts if os.path.exists(part)]
+        if not parts:
+            return None
+        schema = pa.unify_schemas([pq.read_schema(part).remove_metadata() for part in parts]
+                                  + [pa.schema([('project', pa.string())])])
+        partitioning = pads.partitioning(pa.schema([('project', pa.string())]), flavor='hive')
+        return pads.dataset(parts, schema=schema, format='parquet', partitioning=partitioning,
+                            partition_base_dir=self.store_dir)
+
+    def read(self, projects: List[str] = None, columns: List[str] = None) -> pd.DataFrame:
+        """
+        Reads the store, or only some projects, into a DataFrame.
+
+        Args:
+            projects (List[str]): Projects to read (all if None); only their folders are opened.
+            columns (List[str]): Columns to read (all if None).
+        """
+        dataset = self.dataset(projects)
+        if dataset is None:
+            return pd.DataFrame(columns=columns)
+        return dataset.to_table(columns=columns).to_pandas()
+
+    def projects(self) -> pd.DataFrame:
+        """Number of CSVs, studies and skipped duplicates per project."""
+        return pd.read_sql_query("SELECT project, COUNT(*) AS n_csvs, SUM(n_rows) AS n_studies, "
+                                 "SUM(n_duplicates) AS n_duplicates FROM sources WHERE project IS NOT NULL "
+                                 "GROUP BY project", self.conn)
 
-# Get all CSV files in the folder containing the name component
-csv_files = [
-    os.path.join(folder_name, file_name)
-    for file_name in os.listdir(folder_name)
-    if file_name.endswith('.csv') and name_component.lower() in file_name.lower()
-]
 
-# Read and concatenate all CSV files
-combined_data = pd.concat([pd.read_csv(file) for file in csv_files], ignore_index=True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help="Add new or changed metadata CSVs to the store")
+    ingest_parser.add_argument('folder', help="Folder of the metadata CSVs, e.g. metadata")
+    ingest_parser.add_argument('--store', required=True, help="Folder of the collated store")
+    ingest_parser.add_argument('--pattern', default='*.csv', help="File name pattern of the CSVs to ingest")
+    ingest_parser.add_argument('--project', default=None,
+                               help="Project of the ingested CSVs (default: file name up to the first '_')")
+    export_parser = commands.add_parser('export', help="Write the collated metadata to one CSV")
+    export_parser.add_argument('--store', required=True, help="Folder of the collated store")
+    export_parser.add_argument('--output', required=True, help="CSV file to write")
+    export_parser.add_argument('--projects', nargs='+', default=None, help="Projects to export (default: all)")
+    args = parser.parse_args()
 
-# Save the combined DataFrame to a new CSV file
-combined_data.to_csv(os.path.join(folder_name, "mavacamten_metadata_collated_20250611.csv"), index=False)
\ No newline at end of file
+    with MetadataStore(args.store) as store:
+        if args.command == 'ingest':
+            store.ingest_folder(args.folder, args.pattern, args.project)
+            print(store.projects().to_string(index=False))
+        else:
+            collated = store.read(args.projects)
+            collated.to_csv(args.output, index=False)
+            print(f"{len(collated)} studies saved to {args.output}")
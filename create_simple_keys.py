@@ -6,99 +6,106 @@ Date: 08-06-2025
 """
 
 import os
-import pydicom
-import csv
 import zipfile
-import tempfile
-import shutil
 
-def create_anon_keys(input_dir, output_csv):
+from anon_keys import KeyRegistry
+from dicom_index import DicomIndex
+from dicom_io import read_dicom_header, thread_map
+from run_metrics import Progress, RunMetrics
+
+def create_anon_keys(input_dir, output_csv, index=None, io_threads=1, metrics=None):
     """
     Iterate through folders or zipped folders containing DICOM files, extract PatientID, and create anonymized keys.
-    Save the keys in a CSV file with columns: PatientID, AnonID.
+    Save the keys in a CSV file with columns: mrn, AnonID.
+    If output_csv already exists, its keys are kept and only new PatientIDs are appended, numbered
+    after the highest existing AnonID (see anon_keys.KeyRegistry), so top-up cohorts extend earlier keys.
+    Files are listed from `index` (a scanned DicomIndex of input_dir), which is built if not given.
+    With io_threads > 1, that many files are read concurrently (useful on network shares);
+    keys are still assigned in file order.
+    Timers and counters are recorded under the 'keys' stage of `metrics` (a RunMetrics).
+    Returns the KeyRegistry.
     """
-    anon_keys = {}
-    counter = 1
-    temp_dir = tempfile.mkdtemp()  # Create a temporary directory at the start
+    index = index or DicomIndex(input_dir).scan()
+    metrics = metrics or RunMetrics()
 
-    try:
-        # Walk through all files in the input directory
-        for root, _, files in os.walk(input_dir):
-            print(f"Processing directory: {root}")  # Debugging log
-            for file in files:
-                file_path = os.path.join(root, file)
-                print(f"Found file: {file_path}")  # Debugging log
-
-                if file.lower().endswith('.zip'):  # Handle zipped folders
-                    print(f"Processing zip file: {file_path}")  # Debugging log
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)  # Extract all contents to the temporary directory
-                        zip_patient_id = os.path.splitext(file)[0]  # Extract patient ID from zip file name
-                        first_dicom = find_first_dicom(temp_dir, expected_patient_id=zip_patient_id)  # Match PatientID
-                        if first_dicom:  # If a DICOM file is found
-                            print(f"Found DICOM file in zip: {first_dicom}")  # Debugging log
-                            process_dicom_file(first_dicom, anon_keys, counter)
-                            counter = len(anon_keys) + 1  # Update counter after processing
-
-                elif file.lower().endswith('.dcm'):  # Handle individual DICOM files
-                    print(f"Processing DICOM file: {file_path}")  # Debugging log
-                    process_dicom_file(file_path, anon_keys, counter)
-                    counter = len(anon_keys) + 1  # Update counter after processing
-
-        # Write the keys to a CSV file
-        with open(output_csv, mode='w', newline='') as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerow(["PatientID", "AnonID"])  # Write header
-            for patient_id, anon_id in anon_keys.items():
-                writer.writerow([patient_id, anon_id])
-
-    finally:
-        shutil.rmtree(temp_dir)  # Clean up the temporary directory at the end
-        print("Temporary directory cleaned up.")  # Debugging log
-
-
-def find_first_dicom(directory, expected_patient_id=None):
+    # Go through all files in the input directory
+    patient_ids = []
+    with metrics.run_stage('keys') as stage:
+        progress = Progress('keys', len(index.files))
+        with stage.timer('read'):
+            for patient_id in thread_map(read_file_patient_id, index.files, io_threads):
+                stage.count(files=1, skipped=int(patient_id is None))
+                progress.update()
+                patient_ids.append(patient_id)
+
+    # Keys logic: one batch of new AnonIDs for the PatientIDs not in the key file yet
+    registry = KeyRegistry(output_csv)
+    new_keys = registry.add(patient_ids)
+    print(f"{len(new_keys)} new keys, {len(registry)} in total")
+    registry.save()
+    return registry
+
+
+def find_first_dicom_in_zip(zip_ref, expected_patient_id=None):
+    """
+    Search an open zip file for the first valid DICOM member without extracting it.
+    If expected_patient_id is provided, ensure the DICOM member matches it.
+    """
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        try:
+            with zip_ref.open(info) as member:
+                dicom_data = read_dicom_header(member, specific_tags=["PatientID"])
+            patient_id = dicom_data.get("PatientID", None)
+
+            # If expected_patient_id is provided, ensure it matches
+            if expected_patient_id:
+                if patient_id == expected_patient_id:
+                    return info.filename
+            else:
+                return info.filename  # Return the first valid DICOM member
+        except:
+            continue  # Skip members that are not valid DICOM files
+    return None  # Return None if no matching DICOM member is found
+
+
+def read_file_patient_id(indexed):
     """
-    Recursively search for the first valid DICOM file in a directory.
-    If expected_patient_id is provided, ensure the DICOM file matches it.
+    Read the PatientID of an indexed zip (first matching DICOM member) or DICOM file.
+    Returns None for other files.
     """
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                # Attempt to read the file as a DICOM file
-                dicom_data = pydicom.dcmread(file_path)
-                patient_id = dicom_data.get("PatientID", None)
-
-                # If expected_patient_id is provided, ensure it matches
-                if expected_patient_id:
-                    if patient_id == expected_patient_id:
-                        return file_path
-                else:
-                    return file_path  # Return the first valid DICOM file
-            except:
-                continue  # Skip files that are not valid DICOM files
-    return None  # Return None if no matching DICOM file is found
-
-
-def process_dicom_file(dicom_path, anon_keys, counter):
+    file, file_path = os.path.basename(indexed.rel_path), indexed.path
+
+    if file.lower().endswith('.zip'):  # Handle zipped folders
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            zip_patient_id = os.path.splitext(file)[0]  # Extract patient ID from zip file name
+            first_dicom = find_first_dicom_in_zip(zip_ref, expected_patient_id=zip_patient_id)  # Match PatientID
+            if first_dicom:  # If a DICOM member is found, read it straight from the zip
+                with zip_ref.open(first_dicom) as dicom_file:
+                    return read_patient_id(dicom_file)
+
+    elif file.lower().endswith('.dcm') or indexed.is_dicom:  # Handle individual DICOM files
+        return read_patient_id(file_path)
+    return None
+
+
+def read_patient_id(dicom_path):
     """
-    Process a single DICOM file to extract PatientID and create an anonymized key.
+    Read the PatientID of a single DICOM file (path or open file), or None if it has none.
     """
     try:
-        dicom_data = pydicom.dcmread(dicom_path)
+        dicom_data = read_dicom_header(dicom_path, specific_tags=["PatientID"])
         patient_id = dicom_data.get("PatientID", None)
 
         if patient_id:
-            print(f"Extracted PatientID: {patient_id} from {dicom_path}")  # Debugging log
-            if patient_id not in anon_keys:
-                anon_keys[patient_id] = f"A{counter}" # Keys logic
-        else:
-            print(f"No PatientID found in {dicom_path}")  # Debugging log
+            return patient_id
     except Exception as e:
         print(f"Error reading file {dicom_path}: {e}")
+    return None
 
 # usage
-input_directory = 'E:/AphCM_Beckys_list/ApHCM/ApHCM'
-output_csv_file = 'keys/ApHCM_simple_keys.csv'
-create_anon_keys(input_directory, output_csv_file)
\ No newline at end of file
+if __name__ == "__main__":
+    input_directory = 'E:/AphCM_Beckys_list/ApHCM/ApHCM'
+    output_csv_file = 'keys/ApHCM_simple_keys.csv'
+    create_anon_keys(input_directory, output_csv_file)
@@ -0,0 +1,158 @@
+"""
+Content-based deduplication of anonymised files.
+
+A file is identified by its SOPInstanceUID, a fast hash of its content, the AnonID of its
+study and a fingerprint of the anonymisation rules: two files with the same key give
+the same anonymised output. The `DedupIndex` (SQLite) records the output written for
+each key, so a later file with the same key, elsewhere in the source tree or in a later
+top-up run, can be hard-linked to (or skipped in favour of) that output instead of being
+parsed and rewritten again.
+
+An output is only reused while its size and mtime are those recorded when it was
+written, so a file that was since overwritten (e.g. by a fresh copy of the source) is
+never linked to.
+
+The content hash is xxHash (XXH3-128) if the `xxhash` package is installed, otherwise
+BLAKE2b; hashes are prefixed with the algorithm, so indexes written with either never mix.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional, Tuple
+
+try:
+    import xxhash
+except ImportError:  # Optional, BLAKE2b is used instead
+    xxhash = None
+
+MODES = ('link', 'skip')
+
+
+def default_dedup_path(anon_dir: str) -> str:
+    """Returns the dedup index path used for `anon_dir`: `<anon_dir>_dedup.sqlite` next to it."""
+    return os.path.normpath(anon_dir) + '_dedup.sqlite'
+
+
+def _new_hash():
+    if xxhash is not None:
+        return 'xxh3', xxhash.xxh3_128()
+    return 'b2', hashlib.blake2b(digest_size=16)
+
+
+def content_hash(source, chunk_size: int = 1 << 20) -> str:
+    """Returns the content hash of a path, an open binary file (read from its start) or bytes."""
+    name, digest = _new_hash()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        digest.update(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    else:
+        source.seek(0)
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return f"{name}:{digest.hexdigest()}"
+
+
+# One DedupIndex per process and path, so worker processes keep one connection between batches
+_process_indexes = {}
+
+
+def _process_dedup_index(index_path: str) -> 'DedupIndex':
+    if index_path not in _process_indexes:
+        _process_indexes[index_path] = DedupIndex(index_path)
+    return _process_indexes[index_path]
+
+
+class DedupIndex:
+    """
+    SQLite index of (SOPInstanceUID, content hash, AnonID, rules fingerprint) -> anonymised output.
+
+    Keys being written in this process are held as pending until `record`, so a duplicate
+    met while its first copy is still being written waits for it rather than being rewritten.
+    Lookups (reader thread) and records (writer thread) may come from different threads.
+
+    Args:
+        index_path (str): SQLite file of the index, shared by runs (and projects) that may overlap;
+            None keeps the index in memory for this process only.
+    """
+
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._recorded = {}  # Written since the last flush
+        self.conn = sqlite3.connect(index_path or ':memory:', timeout=60, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                sop_instance_uid TEXT,
+                content_hash TEXT,
+                anon_id TEXT,
+                plan TEXT,
+                output_path TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                PRIMARY KEY (sop_instance_uid, content_hash, anon_id, plan)
+            )
+        """)
+        self.conn.commit()
+
+    def __reduce__(self):
+        if self.index_path is None:
+            return DedupIndex, ()
+        return _process_dedup_index, (self.index_path,)
+
+    def lookup(self, key: Tuple, include_pending: bool = True) -> Optional[str]:
+        """
+        Returns the output written for `key` if it is still intact (or, with `include_pending`,
+        the output of a file with that key that is being written in this process), else None.
+        """
+        with self._lock:
+            if include_pending and key in self._pending:
+                return self._pending[key]
+            row = self._recorded.get(key)
+            if row is None:
+                row = self.conn.execute("SELECT output_path, size, mtime_ns FROM outputs WHERE sop_instance_uid = ? "
+                                        "AND content_hash = ? AND anon_id = ? AND plan = ?", key).fetchone()
+        if row is None:
+            return None
+        output_path, size, mtime_ns = row
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            return None
+        return output_path if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns) else None
+
+    def reserve(self, key: Tuple, output_path: str):
+        """Marks `key` as being written to `output_path` by this process."""
+        with self._lock:
+            self._pending[key] = output_path
+
+    def release(self, key: Tuple):
+        """Drops a reservation whose file could not be written."""
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def record(self, key: Tuple, output_path: str):
+        """Records the output written for `key` (saved to the index by `flush`)."""
+        stat = os.stat(output_path)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._recorded[key] = (output_path, stat.st_size, stat.st_mtime_ns)
+
+    def flush(self):
+        """Saves the outputs recorded since the last flush, in one short transaction."""
+        with self._lock:
+            if not self._recorded:
+                return
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [(*key, *row) for key, row in self._recorded.items()])
+            self._recorded = {}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
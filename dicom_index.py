@@ -0,0 +1,149 @@
+"""
+Index of the files in a study tree, built with a single `os.scandir` pass.
+
+Each file is recorded as study -> series -> file, with its size, mtime and whether
+it starts with the DICOM preamble ('DICM' at byte 128). The index can be saved to
+SQLite and reused by every stage (metadata, anonymisation, key generation) instead
+of walking the tree again. Re-scanning reuses the DICM check for unchanged files.
+"""
+
+import os
+import sqlite3
+from collections import namedtuple
+from typing import Dict, List
+
+IndexedFile = namedtuple('IndexedFile', ['study', 'series', 'rel_path', 'size', 'mtime', 'is_dicom', 'path'])
+
+
+def default_index_path(root_directory: str) -> str:
+    """Returns the index path used for `root_directory`: `<root_directory>_index.sqlite` next to it."""
+    return os.path.normpath(root_directory) + '_index.sqlite'
+
+
+def has_dicom_preamble(file_path: str) -> bool:
+    """Checks for the 'DICM' prefix after the 128-byte preamble."""
+    try:
+        with open(file_path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+class DicomIndex:
+    """
+    File index of a study tree: top-level directories are studies, their subdirectories are series.
+
+    Files directly in a study have an empty series; files directly in the root have an empty study.
+
+    Args:
+        root_directory (str): Root of the study tree.
+        index_path (str): SQLite file to save the index to and load it from (None = in memory only).
+    """
+
+    def __init__(self, root_directory: str, index_path: str = None):
+        if not os.path.isdir(root_directory):
+            raise ValueError(f"Invalid root directory: {root_directory}")
+        self.root_directory = root_directory
+        self.index_path = index_path
+        self.files = []
+        self._by_study = {}
+
+    def scan(self, studies: List[str] = None) -> 'DicomIndex':
+        """
+        Scans the tree (reusing DICM checks of unchanged files from a saved index) and saves it.
+
+        Args:
+            studies (List[str]): If given, only these study directories are scanned (files directly
+                in the root are always listed), e.g. for one shard of a sharded run.
+        """
+        wanted = None if studies is None else set(studies)
+        previous = {}
+        if self.index_path and os.path.exists(self.index_path):
+            previous = {f.rel_path: f for f in self._read_index()}
+
+        files = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            with os.scandir(os.path.join(self.root_directory, rel_dir)) as entries:
+                entries = sorted(entries, key=lambda e: e.name)
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if rel_dir or wanted is None or entry.name in wanted:
+                        stack.append(rel_path)
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                old = previous.get(rel_path)
+                if old is not None and old.size == stat.st_size and old.mtime == stat.st_mtime:
+                    is_dicom = old.is_dicom
+                else:
+                    is_dicom = has_dicom_preamble(entry.path)
+                parts = rel_path.split(os.sep)
+                study = parts[0] if len(parts) > 1 else ''
+                series = os.sep.join(parts[1:-1])
+                files.append(IndexedFile(study, series, rel_path, stat.st_size, stat.st_mtime, is_dicom, entry.path))
+
+        self._set_files(sorted(files, key=lambda f: f.rel_path))
+        if self.index_path and studies is None:  # A partial scan would overwrite the full index
+            self.save()
+        return self
+
+    def load(self) -> 'DicomIndex':
+        """Loads a saved index without touching the tree."""
+        self._set_files(self._read_index())
+        return self
+
+    def save(self):
+        """Saves the index to `index_path`."""
+        with sqlite3.connect(self.index_path) as conn:
+            conn.execute("DROP TABLE IF EXISTS files")
+            conn.execute("""
+                CREATE TABLE files (
+                    rel_path TEXT PRIMARY KEY, study TEXT, series TEXT,
+                    size INTEGER, mtime REAL, is_dicom INTEGER
+                )
+            """)
+            conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                             [(f.rel_path, f.study, f.series, f.size, f.mtime, int(f.is_dicom)) for f in self.files])
+        conn.close()
+
+    def _read_index(self) -> List[IndexedFile]:
+        conn = sqlite3.connect(self.index_path)
+        try:
+            rows = conn.execute("SELECT study, series, rel_path, size, mtime, is_dicom FROM files ORDER BY rel_path")
+            return [IndexedFile(study, series, rel_path, size, mtime, bool(is_dicom),
+                                os.path.join(self.root_directory, rel_path))
+                    for study, series, rel_path, size, mtime, is_dicom in rows]
+        finally:
+            conn.close()
+
+    def _set_files(self, files: List[IndexedFile]):
+        self.files = files
+        self._by_study = {}
+        for f in files:
+            self._by_study.setdefault(f.study, []).append(f)
+
+    def studies(self) -> List[str]:
+        """Returns the study directory names."""
+        return [study for study in self._by_study if study]
+
+    def study_files(self, study: str, dicom_only: bool = False) -> List[IndexedFile]:
+        """Returns the files of a study, optionally only those with a DICOM preamble."""
+        files = self._by_study.get(study, [])
+        return [f for f in files if f.is_dicom] if dicom_only else files
+
+    def series(self, study: str) -> Dict[str, List[IndexedFile]]:
+        """Returns the files of a study grouped by series directory."""
+        series = {}
+        for f in self._by_study.get(study, []):
+            series.setdefault(f.series, []).append(f)
+        return series
+
+    def first_dicom(self, study: str):
+        """Returns the path of the first file with a DICOM preamble in a study (series first), or None."""
+        files = sorted(self._by_study.get(study, []), key=lambda f: f.series == '')
+        return next((f.path for f in files if f.is_dicom), None)
@@ -0,0 +1,217 @@
+"""
+Helpers for reading DICOM files without loading more of them than needed.
+
+Metadata and key generation only look at a handful of header tags, so reading
+the whole file (pixel data included) wastes most of the I/O on large
+enhanced multi-frame files. Anonymisation likewise rewrites only the header
+and copies the pixel data across with `copy_tail`. Header values larger than
+`DEFER_SIZE` are left on disk until they are accessed, and `find_all_tags`
+only decodes sequences and the elements it looks for, so memory stays bounded
+however large the file.
+"""
+
+import io
+import os
+import struct
+import sys
+
+import pydicom
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List
+
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+
+# Header values larger than this (bytes) are only read from the file when accessed
+DEFER_SIZE = 1024 * 1024
+
+
+def read_dicom_header(filepath, specific_tags: List[str] = None, force: bool = False, defer_size: int = DEFER_SIZE):
+    """
+    Reads a DICOM file up to, but not including, the pixel data.
+
+    Args:
+        filepath (str or file-like): Path to (or open binary file of) the DICOM file.
+        specific_tags (List[str]): If given, only these top-level tags are decoded.
+            Tags nested in sequences are only kept if their sequence is listed.
+        force (bool): Read files without a DICOM preamble.
+        defer_size (int): Values larger than this many bytes are read when accessed (None = read all).
+            Only applies to paths, as deferred values are read back by file name.
+
+    Returns:
+        pydicom.dataset.FileDataset: The header dataset.
+    """
+    if not isinstance(filepath, (str, os.PathLike)):
+        defer_size = None
+    return pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=specific_tags, force=force,
+                           defer_size=defer_size)
+
+
+def _is_sequence(dataset, elem) -> bool:
+    """Checks whether an element is a sequence without decoding it, unless it is private and its VR implicit."""
+    if elem.VR == 'SQ':
+        return True
+    if elem.VR not in (None, 'UN'):
+        return False
+    if not elem.tag.is_private:
+        try:
+            return dictionary_VR(elem.tag) == 'SQ'
+        except KeyError:
+            return False
+    return dataset[elem.tag].VR == 'SQ'
+
+
+def find_all_tags(dataset, tag_keyword: str) -> List:
+    """
+    Recursively find all occurrences of a specified tag in a DICOM dataset.
+
+    Only sequences and the elements with the tag are decoded; other elements (deferred
+    ones included) are skipped as they were read.
+
+    Args:
+        dataset (pydicom.dataset.Dataset): The DICOM dataset to search.
+        tag_keyword (str): The DICOM tag keyword to search for.
+
+    Returns:
+        list: A list of all values found for the specified tag.
+    """
+    tag = tag_for_keyword(tag_keyword)
+    values = []
+    for elem in dataset.elements():
+        if elem.tag == tag:  # Check if the tag matches
+            values.append(dataset[tag].value)
+        elif _is_sequence(dataset, elem):  # If the element is a sequence, recurse into it
+            for item in dataset[elem.tag].value:
+                values.extend(find_all_tags(item, tag_keyword))
+    return values
+
+
+def match_mrn(dataset, valid_mrns: set) -> str:
+    """
+    Returns the first PatientID in the dataset (nested ones included) that is a valid MRN, or 'NA'.
+    Without `valid_mrns` (None), returns the top-level PatientID.
+    """
+    if valid_mrns is None:
+        return str(dataset.get('PatientID', 'NA'))
+    for patient_id in find_all_tags(dataset, "PatientID"):
+        if patient_id in valid_mrns:
+            return patient_id
+    return 'NA'
+
+
+def thread_map(func: Callable, items: Iterable, max_in_flight: int = 16) -> Iterator:
+    """
+    Yields `func(item)` for every item, in input order, with up to `max_in_flight` calls
+    running at once in a thread pool.
+
+    Meant for I/O-bound reads (e.g. headers on SMB shares) where per-file latency dominates:
+    overlapping the waits hides most of it. At most `2 * max_in_flight` calls are queued,
+    so memory stays bounded for long file lists.
+
+    Args:
+        func (Callable): Function of one item; exceptions are re-raised when its result is reached.
+        items (Iterable): Items to map over.
+        max_in_flight (int): Number of concurrent calls (1 = plain sequential map).
+    """
+    if not max_in_flight or max_in_flight <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Explicit VR elements whose length is 4 bytes (after 2 reserved bytes) rather than 2
+LONG_LENGTH_VRS = (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV')
+UNDEFINED_LENGTH = 0xFFFFFFFF
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+
+
+def skip_element(src, implicit_vr: bool, little_endian: bool) -> bool:
+    """
+    Moves `src` (an open binary file at the start of a data element) past that element, e.g. past
+    the pixel data to the elements after it. Encapsulated (undefined length) values are skipped
+    item by item, reading only the item headers.
+
+    Returns:
+        bool: False if `src` was at the end of the file (no element to skip).
+    """
+    endian = '<' if little_endian else '>'
+    header = src.read(8)
+    if not header:
+        return False
+    if len(header) < 8:
+        raise ValueError("Truncated data element")
+    if implicit_vr:
+        length = struct.unpack(endian + 'L', header[4:])[0]
+    elif header[4:6] in LONG_LENGTH_VRS:
+        length = struct.unpack(endian + 'L', src.read(4))[0]
+    else:
+        length = struct.unpack(endian + 'H', header[6:])[0]
+    if length != UNDEFINED_LENGTH:
+        src.seek(length, os.SEEK_CUR)
+        return True
+    # Items (fragments) up to the sequence delimiter, each with an implicit VR style header
+    while True:
+        item = src.read(8)
+        if len(item) < 8:
+            raise ValueError("Undefined length element without a sequence delimiter")
+        group, element, item_length = struct.unpack(endian + 'HHL', item)
+        if (group, element) == SEQUENCE_DELIMITER:
+            return True
+        src.seek(item_length, os.SEEK_CUR)
+
+
+def copy_tail(src, dst, offset: int, block_size: int = 1024 * 1024) -> int:
+    """
+    Copies `src` from byte `offset` to its end onto the end of `dst` (both open binary files).
+
+    Uses `os.copy_file_range` or `os.sendfile`, so the bytes go from file to file inside
+    the kernel without passing through Python, and falls back to block copies where neither
+    is available (e.g. Windows) or supported by the file systems involved.
+
+    Returns:
+        int: Number of bytes copied.
+    """
+    dst.flush()
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        remaining = os.fstat(src_fd).st_size - offset
+    except (AttributeError, io.UnsupportedOperation):
+        src_fd = None
+        src.seek(0, os.SEEK_END)
+        remaining = src.tell() - offset
+    total = remaining
+
+    if src_fd is not None:
+        kernel_copies = []
+        if hasattr(os, 'copy_file_range'):
+            kernel_copies.append(lambda n: os.copy_file_range(src_fd, dst_fd, n, offset))
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            kernel_copies.append(lambda n: os.sendfile(dst_fd, src_fd, offset, n))
+        for kernel_copy in kernel_copies:
+            try:
+                while remaining > 0:
+                    n = kernel_copy(remaining)
+                    if n == 0:
+                        break
+                    offset += n
+                    remaining -= n
+            except OSError:
+                continue  # e.g. EXDEV across file systems on older kernels, try the next way
+            break
+
+    src.seek(offset)
+    while remaining > 0:
+        block = src.read(min(block_size, remaining))
+        if not block:
+            break
+        dst.write(block)
+        remaining -= len(block)
+    return total - remaining
@@ -0,0 +1,111 @@
+"""
+Persistent job manifest for resumable anonymisation runs.
+
+A SQLite file next to the anonymised directory records, per source file, its size,
+mtime, content hash, output path and status. Re-runs only process files that are
+new, changed or failed last time, so interrupted runs and top-up cohorts do not
+redo the whole cohort.
+"""
+
+import hashlib
+import os
+import sqlite3
+from typing import Dict, List, Tuple
+
+# Statuses that mean a file does not need to be processed again
+DONE_STATUSES = ('anonymised', 'copied', 'skipped', 'linked', 'duplicate')
+
+
+def default_manifest_path(anon_dir: str) -> str:
+    """Returns the manifest path used for `anon_dir`: `<anon_dir>_manifest.sqlite` next to it."""
+    return os.path.normpath(anon_dir) + '_manifest.sqlite'
+
+
+def file_fingerprint(file_path: str, chunk_size: int = 1 << 20) -> Tuple[int, float, str]:
+    """Returns (size, mtime, BLAKE2b content hash) for a file."""
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+class JobManifest:
+    """
+    SQLite-backed record of which files have been processed.
+
+    Only the main process writes to the manifest; workers return fingerprints with their results.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.conn = sqlite3.connect(manifest_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                source_path TEXT PRIMARY KEY,
+                anon_id TEXT,
+                output_path TEXT,
+                size INTEGER,
+                mtime REAL,
+                content_hash TEXT,
+                status TEXT,
+                error TEXT,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def pending(self, tasks: List) -> List:
+        """
+        Filters (file path, AnonID, output path) tasks down to those that need processing:
+        new files, files whose content changed, files that failed, and files whose output is missing.
+        """
+        records = {
+            row[0]: row[1:] for row in
+            self.conn.execute("SELECT source_path, anon_id, output_path, size, mtime, content_hash, status FROM files")
+        }
+        pending, touched = [], []
+        for task in tasks:
+            path, anon_id, output_path = task
+            record = records.get(path)
+            if (record is None or record[5] not in DONE_STATUSES or record[0] != anon_id
+                    or record[1] != output_path or not os.path.exists(output_path)):
+                pending.append(task)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                pending.append(task)
+                continue
+            if stat.st_size == record[2] and stat.st_mtime == record[3]:
+                continue
+            if stat.st_size == record[2]:
+                # Same size, new mtime: only the hash can tell whether the content changed
+                size, mtime, content_hash = file_fingerprint(path)
+                if content_hash == record[4]:
+                    touched.append((mtime, path))
+                    continue
+            pending.append(task)
+
+        if touched:
+            self.conn.executemany("UPDATE files SET mtime = ? WHERE source_path = ?", touched)
+            self.conn.commit()
+        return pending
+
+    def record(self, results: List[Dict]):
+        """Stores per-file results (with size, mtime and content_hash where available)."""
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO files (source_path, anon_id, output_path, size, mtime, content_hash, status, error)
+            VALUES (:FilePath, :AnonID, :OutputPath, :size, :mtime, :content_hash, :status, :error)
+        """, [{'size': None, 'mtime': None, 'content_hash': None, **r} for r in results])
+        self.conn.commit()
@@ -12,7 +12,12 @@ Date: 11-04-2025
 
 from anonymise_dicoms import MetadataExtraction, Anonymisation
 from unzip import ZipFolderHandler
-import pandas as pd
+from job_manifest import default_manifest_path
+from dicom_index import DicomIndex, default_index_path
+from run_metrics import RunMetrics
+from anon_keys import KeyRegistry
+from sharding import ShardedRun
+from dedup import default_dedup_path
 import os
 
 # --- USER DEFINED VARIABLES ---
@@ -22,41 +27,165 @@ mrn_dir = r"D:\ApHCM\ahcm_topup\original"
 # Destination directory (will create folder if it does not exist)
 anon_dir = r"D:\ApHCM\ahcm_topup\ahcm_topup_anonymised"
 
-# CSV file with AnonID keys
-keys_df = pd.read_csv("keys/keys_aphcm_topup_posthoc.csv", dtype=str)
+# CSV file with AnonID keys (columns mrn, AnonID)
+keys_path = "keys/keys_aphcm_topup_posthoc.csv"
+
+# Give MRNs without a key a new AnonID (after the highest existing one) and append them to keys_path,
+# instead of only keeping studies whose MRN is already in the keys
+add_new_keys = False
 
 # Name and path of metadata CSV
 extracted_metadata_path = "metadata/AHCM_topup.csv"
 
+# Number of worker processes for anonymisation (1 = sequential, None = all CPUs)
+n_workers = 1
+
+# Number of concurrent header reads for metadata (raise on network shares, e.g. 16)
+io_threads = 1
+
+# Read, anonymise and write each file in one pass instead of copy -> rename -> anonymise
+single_pass = False
+
+# Source studies are zips: stream them into <AnonID>_<formatted_date>.zip without extracting to disk
+zipped_source = False
+
+# Keep a job manifest next to anon_dir so re-runs only process new, changed or failed files
+# or zips (resumed runs are always single-pass, so nothing is copied again and no raw study folders are left in anon_dir)
+resume = False
+
+# Optional per-instance metadata (Parquet) for every DICOM file, e.g. "metadata/AHCM_topup_instances.parquet"
+instance_metadata_path = None
+
+# Save the scan of mrn_dir next to it, so later runs only re-check files that changed
+save_index = False
+
+# Optional JSON file with per-stage timers (read / tag walk / write) and counters, e.g. "metadata/AHCM_topup_metrics.json"
+metrics_path = None
+
+# Optional folder for cProfile reports of each stage (run with n_workers = 1 to profile the per-file work)
+profile_dir = None
+
+# Files read ahead of, and written behind, the tag rewrite so disk and CPU work overlap (0 = one file at a time)
+queue_size = 4
+
+# Replace every instance UID (study, series, SOP instance, frame of reference, nested references) with a salted
+# hash, the same in every file and run. Keep uid_salt secret and unchanged for a project; uid_map_path optionally
+# records the original -> anonymised UIDs (keep it as safe as the keys), e.g. "keys/AHCM_uid_map.sqlite".
+# uid_salt must be set (a long random string) when hash_uids is True, otherwise the run stops
+hash_uids = False
+uid_salt = ""
+uid_map_path = None
+
+# Files with the same SOPInstanceUID and content as one already anonymised (re-exported studies, repeated
+# slices, top-up runs over earlier outputs): 'link' hard-links them to that output, 'skip' leaves them out
+# (deleting their copy in anon_dir when anonymising in place).
+# The index of written outputs is kept next to anon_dir. None = anonymise every file.
+dedup = None
+
+# Files (and zip members) of at least this many bytes, e.g. enhanced multi-frame or 4D flow files, are always
+# anonymised by streaming their pixel data through, so worker memory stays bounded whatever the file size
+large_file_size = 1024 ** 3
+
+# Split the run into this many shards of studies (e.g. 64), kept in a work queue next to anon_dir.
+# local_shard_workers processes here take shards from the queue; other machines running this script
+# with the same paths join in. Shards are single-pass (or zip-to-zip) and their metadata CSVs are
+# merged into extracted_metadata_path at the end. None = no sharding.
+n_shards = None
+local_shard_workers = 1
+
 # --- RUNNING CODE ---
-# IF NEEDED,
-# zip_handler = ZipFolderHandler(mrn_dir, anon_dir)
-# zip_handler.process_all_zipped_folders()
+if __name__ == "__main__":
+    if hash_uids and not uid_salt:
+        raise SystemExit("Set uid_salt to a secret value to hash UIDs (an empty salt makes the hashes reversible)")
+
+    if n_shards:
+        sharded_run = ShardedRun(mrn_dir, anon_dir, keys_path, extracted_metadata_path, zipped_source=zipped_source,
+                                 add_new_keys=add_new_keys, io_threads=io_threads, resume=resume,
+                                 anonymiser_args={'hash_all_uids': hash_uids, 'uid_salt': uid_salt,
+                                                  'uid_map_path': uid_map_path, 'read_queue_size': queue_size,
+                                                  'write_queue_size': queue_size, 'dedup': dedup,
+                                                  'dedup_path': default_dedup_path(anon_dir) if dedup else None,
+                                                  'large_file_size': large_file_size})
+        sharded_run.prepare(n_shards, retry=resume)
+        shard_status = sharded_run.run_local(local_shard_workers)
+        print(shard_status.groupby('status').size().to_string())
+    else:
+        metrics = RunMetrics(profile_dir)
+
+        # IF NEEDED,
+        # zip_handler = ZipFolderHandler(mrn_dir, anon_dir, metrics=metrics, n_workers=n_workers)
+        # zip_handler.process_all_zipped_folders()
+
+        # Scan the source tree once, every stage below reads from this index
+        source_index = DicomIndex(mrn_dir, default_index_path(mrn_dir) if save_index else None).scan()
+
+        # 1. Export metadata from DICOM files before anonymizing -------------------
+        # Extract metadata
+        key_registry = KeyRegistry(keys_path)  # Loaded once
+        valid_mrns = None if add_new_keys else key_registry.valid_mrns
+        metadata_extractor = MetadataExtraction(mrn_dir, index=source_index, metrics=metrics)
+        if zipped_source:
+            metadata_df = metadata_extractor.extract_metadata_from_zips(valid_mrns)
+        else:
+            metadata_df = metadata_extractor.extract_metadata(valid_mrns, io_threads=io_threads)
+
+        # Match AnonID keys
+        if add_new_keys:
+            key_registry.add(metadata_df['mrn'])
+            key_registry.save()
+        metadata_df['AnonID'] = key_registry.map(metadata_df['mrn'])
+
+        # Save metadata to CSV
+        metadata_df.to_csv(extracted_metadata_path, index=False)
+        print(f"Metadata saved to {extracted_metadata_path}")
 
-# 1. Export metadata from DICOM files before anonymizing -------------------
-# Extract metadata
-valid_mrns = set(keys_df['mrn'])
-metadata_extractor = MetadataExtraction(mrn_dir)
-metadata_df = metadata_extractor.extract_metadata(valid_mrns)
+        # Per-instance metadata for series-level analysis (requires pyarrow)
+        if instance_metadata_path and not zipped_source:
+            metadata_extractor.extract_instance_metadata(instance_metadata_path, valid_mrns, n_workers=n_workers,
+                                                         io_threads=io_threads if io_threads > 1 else None)
 
-# Match AnonID keys
-metadata_df['AnonID'] = metadata_df['mrn'].map(keys_df.set_index('mrn')['AnonID'])
+        # 2. Anonymize DICOM data -------------------
+        anonymiser = Anonymisation(metrics=metrics, hash_all_uids=hash_uids, uid_salt=uid_salt,
+                                   uid_map_path=uid_map_path, read_queue_size=queue_size, write_queue_size=queue_size,
+                                   dedup=dedup, dedup_path=default_dedup_path(anon_dir) if dedup else None,
+                                   large_file_size=large_file_size)
+        manifest_path = default_manifest_path(anon_dir) if resume else None
 
-# Save metadata to CSV
-metadata_df.to_csv(extracted_metadata_path, index=False)
-print(f"Metadata saved to {extracted_metadata_path}")
+        if zipped_source:
+            # Zip-to-zip, replaces unzipping and zipping the anonymised studies
+            summary_df = anonymiser.anonymise_zips(mrn_dir, anon_dir, metadata_df, n_workers=n_workers,
+                                                   manifest_path=manifest_path)
+        elif single_pass or resume:
+            # Write anonymised files straight to <AnonID>_<formatted_date> in anon_dir
+            summary_df = anonymiser.copy_and_anonymise(mrn_dir, anon_dir, metadata_df, n_workers=n_workers,
+                                                       manifest_path=manifest_path, index=source_index)
+        else:
+            # Copy directory, uncomment if used zip class above and files are already copied
+            anonymiser.copy_directory(mrn_dir, anon_dir)
 
-# 2. Anonymize DICOM data -------------------
-anonymiser = Anonymisation()
+            # Rename main folders
+            anonymiser.rename_mainfolders(anon_dir, metadata_df)
 
-# Copy directory, uncomment if used zip class above and files are already copied
-anonymiser.copy_directory(mrn_dir, anon_dir)
+            # Anonymize DICOM tags in place
+            if n_workers == 1:
+                summary_df = None
+                if anonymiser.anonymise_dicom_tags(anon_dir, metadata_df, index=source_index):
+                    print("Anonymization completed successfully.")
+                else:
+                    print("An error occurred during anonymization.")
+            else:
+                summary_df = anonymiser.anonymise_dicom_tags_parallel(anon_dir, metadata_df, n_workers=n_workers,
+                                                                      index=source_index)
 
-# Rename main folders
-anonymiser.rename_mainfolders(anon_dir, metadata_df)
+        if summary_df is not None:
+            errors_df = summary_df[summary_df['status'] == 'error']
+            if errors_df.empty:
+                print("Anonymization completed successfully.")
+            else:
+                print(f"{len(errors_df)} files could not be anonymized:")
+                print(errors_df[['FilePath', 'error']].to_string(index=False))
 
-# Anonymize DICOM tags in place
-if anonymiser.anonymise_dicom_tags(anon_dir, metadata_df):
-    print("Anonymization completed successfully.")
-else:
-    print("An error occurred during anonymization.")
\ No newline at end of file
+        # Where the time went, per stage
+        metrics.print_summary()
+        if metrics_path:
+            metrics.save_json(metrics_path)
@@ -0,0 +1,211 @@
+"""
+Timers, counters and progress reporting for the pipeline stages.
+
+Every stage (metadata, copy, anonymise, unzip...) gets a `StageMetrics` with time spent
+reading, walking tags and writing, and counts of files, bytes, copied, skipped, duplicate
+and failed files. Worker processes return their timings in the per-file results, which
+are added up in the main process, so the split shows whether a slow cohort is bound
+by disk (read/write) or by the tag walk. `Progress` prints a rate-limited progress
+line with throughput and ETA instead of one line per file, and each stage ends
+with a one-line summary.
+
+With a `profile_dir`, each stage run in this process is also profiled with cProfile
+(`<stage>.prof` plus the top functions in `<stage>_profile.json`). Work done inside
+worker processes is not profiled: use n_workers=1 to profile the per-file work.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+TIMERS = ('read', 'tag_walk', 'write')
+COUNTERS = ('files', 'bytes', 'copied', 'skipped', 'duplicates', 'errors')
+
+
+def format_duration(seconds: float) -> str:
+    """Formats seconds as H:MM:SS."""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class StageMetrics:
+    """
+    Timers (seconds spent reading, walking tags and writing) and counters of one stage.
+
+    Timers add up the time of every file, so with several workers they can exceed `wall_time`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timers = dict.fromkeys(TIMERS, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.wall_time = 0.0
+
+    @contextmanager
+    def timer(self, key: str):
+        """Adds the time spent in the block to timer `key`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[key] += time.perf_counter() - start
+
+    def count(self, **counts):
+        """Increments counters, e.g. `count(files=1, bytes=size)`."""
+        for key, value in counts.items():
+            self.counters[key] += value
+
+    def add_result(self, result: Dict):
+        """Adds a per-file result of `Anonymisation` (status, bytes and `<timer>_s` timings)."""
+        for key in TIMERS:
+            self.timers[key] += result.get(f'{key}_s', 0.0)
+        self.counters['files'] += 1
+        self.counters['bytes'] += result.get('bytes', 0)
+        status = result.get('status')
+        if status in ('copied', 'skipped'):
+            self.counters[status] += 1
+        elif status in ('linked', 'duplicate'):
+            self.counters['duplicates'] += 1
+        elif status == 'error':
+            self.counters['errors'] += 1
+
+    def as_dict(self) -> Dict:
+        wall_time = self.wall_time or float('nan')
+        return {'wall_time_s': self.wall_time, **{f'{key}_s': value for key, value in self.timers.items()},
+                **self.counters, 'files_per_s': self.counters['files'] / wall_time,
+                'mb_per_s': self.counters['bytes'] / 1e6 / wall_time}
+
+    def summary(self) -> str:
+        """One-line summary: volume, throughput and where the time went."""
+        line = f"{self.name}: {self.counters['files']} files"
+        if self.counters['bytes']:
+            line += f", {self.counters['bytes'] / 1e6:.1f} MB"
+        line += f" in {format_duration(self.wall_time)}"
+        if self.wall_time > 0:
+            line += f" ({self.counters['files'] / self.wall_time:.1f} files/s"
+            if self.counters['bytes']:
+                line += f", {self.counters['bytes'] / 1e6 / self.wall_time:.1f} MB/s"
+            line += ")"
+        busy = sum(self.timers.values())
+        if busy > 0:
+            line += "; " + ", ".join(f"{key.replace('_', ' ')} {value / busy:.0%}"
+                                     for key, value in self.timers.items() if value > 0)
+        issues = [f"{self.counters[key]} {key}" for key in ('copied', 'skipped', 'duplicates', 'errors')
+                  if self.counters[key]]
+        if issues:
+            line += "; " + ", ".join(issues)
+        return line
+
+
+class RunMetrics:
+    """
+    Metrics of all stages of a run, shared by `MetadataExtraction`, `Anonymisation` and `ZipFolderHandler`.
+
+    Args:
+        profile_dir (str): If given, each stage is profiled with cProfile and the reports are saved there.
+    """
+
+    def __init__(self, profile_dir: str = None):
+        self.profile_dir = profile_dir
+        self.stages = {}
+
+    def stage(self, name: str) -> StageMetrics:
+        """Returns the metrics of stage `name`, created on first use."""
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    @contextmanager
+    def run_stage(self, name: str):
+        """
+        Times a stage (and profiles it with a `profile_dir`), then prints its summary.
+
+        Yields:
+            StageMetrics: The metrics to record the stage's files into.
+        """
+        stage = self.stage(name)
+        profiler = cProfile.Profile() if self.profile_dir else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._save_profile(name, profiler)
+            stage.wall_time += time.perf_counter() - start
+            print(stage.summary())
+
+    def _save_profile(self, name: str, profiler: cProfile.Profile, top: int = 30):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+        stats = pstats.Stats(profiler)
+        rows = []
+        for (file, line, function), (_, n_calls, own_time, cumulative_time, _) in stats.stats.items():
+            rows.append({'function': function, 'file': file, 'line': line, 'calls': n_calls,
+                         'own_s': own_time, 'cumulative_s': cumulative_time})
+        rows.sort(key=lambda row: row['cumulative_s'], reverse=True)
+        with open(os.path.join(self.profile_dir, f'{name}_profile.json'), 'w') as f:
+            json.dump(rows[:top], f, indent=2)
+
+    def report(self) -> Dict:
+        """Returns the metrics of every stage as a dict."""
+        return {name: stage.as_dict() for name, stage in self.stages.items()}
+
+    def save_json(self, path: str):
+        """Saves `report()` to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Run metrics saved to {path}")
+
+    def print_summary(self):
+        for stage in self.stages.values():
+            print(stage.summary())
+
+
+class Progress:
+    """
+    Prints progress (done/total, files/s, MB/s, ETA) at most every `interval` seconds.
+
+    Args:
+        label (str): Name shown at the start of each line.
+        total (int): Total number of items expected.
+        unit (str): Name of the items counted (files, zips...).
+        interval (float): Minimum number of seconds between two lines.
+    """
+
+    def __init__(self, label: str, total: int, unit: str = 'files', interval: float = 5.0):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.bytes = 0
+        self._start = time.perf_counter()
+        self._last_print = self._start
+
+    def update(self, n: int = 1, n_bytes: int = 0):
+        self.done += n
+        self.bytes += n_bytes
+        now = time.perf_counter()
+        if now - self._last_print >= self.interval and self.done < self.total:
+            self._last_print = now
+            self._print(now)
+
+    def _print(self, now: float):
+        elapsed = max(now - self._start, 1e-9)
+        rate = self.done / elapsed
+        line = f"{self.label}: {self.done}/{self.total} {self.unit}"
+        if self.total:
+            line += f" ({self.done / self.total:.0%})"
+        line += f", {rate:.1f} {self.unit}/s"
+        if self.bytes:
+            line += f", {self.bytes / 1e6 / elapsed:.1f} MB/s"
+        if rate > 0:
+            line += f", ETA {format_duration((self.total - self.done) / rate)}"
+        print(line)
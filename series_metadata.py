@@ -0,0 +1,179 @@
+"""
+Per-instance and per-series metadata written as typed columnar batches.
+
+Each DICOM file becomes one row of `INSTANCE_COLUMNS`. Rows are collected in
+fixed-size batches and appended to a Parquet (or Arrow IPC) file as they are
+read, so memory stays bounded however large the cohort is.
+
+Requires `pyarrow`.
+"""
+
+import os
+from datetime import datetime
+from typing import Dict, List
+
+import pandas as pd
+
+from dicom_io import match_mrn, read_dicom_header
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for columnar output
+    pa = pc = pq = None
+
+_valid_mrns = None  # Set once per worker by `set_valid_mrns`, rather than sent with every task
+
+# (column, arrow type name, DICOM keyword or None for file-level columns)
+INSTANCE_COLUMNS = [
+    ('StudyDirName', 'string', None),
+    ('SeriesDirName', 'string', None),
+    ('FilePath', 'string', None),
+    ('FileSize', 'int64', None),
+    ('mrn', 'string', None),
+    ('StudyInstanceUID', 'string', 'StudyInstanceUID'),
+    ('SeriesInstanceUID', 'string', 'SeriesInstanceUID'),
+    ('SOPInstanceUID', 'string', 'SOPInstanceUID'),
+    ('SOPClassUID', 'string', 'SOPClassUID'),
+    ('Modality', 'string', 'Modality'),
+    ('StudyDate', 'date32', 'StudyDate'),
+    ('StudyTime', 'string', 'StudyTime'),
+    ('SeriesNumber', 'int32', 'SeriesNumber'),
+    ('InstanceNumber', 'int32', 'InstanceNumber'),
+    ('SeriesDescription', 'string', 'SeriesDescription'),
+    ('ProtocolName', 'string', 'ProtocolName'),
+    ('Manufacturer', 'string', 'Manufacturer'),
+    ('ManufacturerModelName', 'string', 'ManufacturerModelName'),
+    ('DeviceSerialNumber', 'string', 'DeviceSerialNumber'),
+    ('MagneticFieldStrength', 'float64', 'MagneticFieldStrength'),
+    ('SliceThickness', 'float64', 'SliceThickness'),
+    ('NumberOfFrames', 'int32', 'NumberOfFrames'),
+    ('Rows', 'int32', 'Rows'),
+    ('Columns', 'int32', 'Columns'),
+]
+
+
+def instance_schema():
+    """Returns the Arrow schema of the per-instance table."""
+    _require_pyarrow()
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name, _ in INSTANCE_COLUMNS])
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Columnar metadata output requires pyarrow: pip install pyarrow")
+
+
+def _convert(value, type_name: str):
+    """Converts a DICOM value to the Python type of its column, None if missing or invalid."""
+    if value is None or value == '':
+        return None
+    try:
+        if type_name.startswith('int'):
+            return int(value)
+        if type_name == 'float64':
+            return float(value)
+        if type_name == 'date32':
+            return datetime.strptime(str(value), '%Y%m%d').date()
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def set_valid_mrns(valid_mrns):
+    """Sets the MRNs `read_instance_record` matches PatientIDs against (None = top-level PatientID)."""
+    global _valid_mrns
+    _valid_mrns = valid_mrns or None
+
+
+def read_instance_record(task) -> Dict:
+    """
+    Reads the header of one DICOM file into an instance row.
+
+    Args:
+        task: Tuple of (file path, StudyDirName, SeriesDirName, file size).
+
+    Returns:
+        Dict: Row of `INSTANCE_COLUMNS`, or None if the file cannot be read as DICOM.
+    """
+    file_path, study, series, size = task
+    try:
+        dcm = read_dicom_header(file_path)
+        record = {'StudyDirName': study, 'SeriesDirName': series, 'FilePath': file_path, 'FileSize': size,
+                  'mrn': match_mrn(dcm, _valid_mrns)}
+        for name, type_name, keyword in INSTANCE_COLUMNS:
+            if keyword is not None:
+                record[name] = _convert(dcm.get(keyword), type_name)
+        return record
+    except Exception as e:
+        print(f"Error reading DICOM {file_path}: {e}")
+        return None
+
+
+class ColumnarWriter:
+    """
+    Appends record batches to a Parquet file (one row group per batch), or to an
+    Arrow IPC file if the path ends in `.arrow` or `.feather`.
+    """
+
+    def __init__(self, output_path: str, schema=None):
+        _require_pyarrow()
+        self.schema = schema or instance_schema()
+        self.rows_written = 0
+        if os.path.splitext(output_path)[1].lower() in ('.arrow', '.feather'):
+            self._writer = pa.ipc.new_file(output_path, self.schema)
+        else:
+            self._writer = pq.ParquetWriter(output_path, self.schema)
+
+    def write(self, records: List[Dict]):
+        if not records:
+            return
+        self._writer.write_batch(pa.RecordBatch.from_pylist(records, schema=self.schema))
+        self.rows_written += len(records)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_instances(path: str, columns: List[str] = None):
+    """Reads a per-instance Parquet or Arrow IPC file back as an Arrow table."""
+    _require_pyarrow()
+    if os.path.splitext(path)[1].lower() in ('.arrow', '.feather'):
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return table.select(columns) if columns else table
+    return pq.read_table(path, columns=columns)
+
+
+def series_summary(instance_path: str) -> pd.DataFrame:
+    """
+    Summarises a per-instance file into one row per series, with slice/frame counts.
+
+    Args:
+        instance_path (str): Output of `MetadataExtraction.extract_instance_metadata`.
+
+    Returns:
+        pd.DataFrame: One row per (StudyDirName, SeriesInstanceUID).
+    """
+    first_columns = ['mrn', 'StudyInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName',
+                     'Modality', 'Manufacturer', 'ManufacturerModelName', 'DeviceSerialNumber', 'StudyDate']
+    table = read_instances(instance_path, ['StudyDirName', 'SeriesInstanceUID', 'SOPInstanceUID',
+                                           'NumberOfFrames', 'FileSize'] + first_columns)
+    # Single-frame images have no NumberOfFrames
+    frames = table.schema.get_field_index('NumberOfFrames')
+    table = table.set_column(frames, 'NumberOfFrames', pc.fill_null(table['NumberOfFrames'], 1))
+    summary = table.group_by(['StudyDirName', 'SeriesInstanceUID'], use_threads=False).aggregate(
+        [('SOPInstanceUID', 'count'), ('NumberOfFrames', 'sum'), ('FileSize', 'sum')]
+        + [(column, 'first') for column in first_columns]
+    )
+    df = summary.to_pandas()
+    df = df.rename(columns={'SOPInstanceUID_count': 'n_instances', 'NumberOfFrames_sum': 'n_frames',
+                            'FileSize_sum': 'total_bytes'})
+    return df.rename(columns={f'{column}_first': column for column in first_columns})
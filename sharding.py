@@ -0,0 +1,369 @@
+"""
+Sharded runs: one cohort split across several worker processes or machines.
+
+Studies are assigned to shards by a stable hash of their directory (or zip) name, so
+the same study always lands in the same shard, whoever lists the cohort. The shards
+are kept in a SQLite work queue next to the anonymised directory; each worker claims
+the next pending shard, extracts its metadata, assigns keys, anonymises its studies
+and writes a per-shard metadata CSV. When the last shard is done the per-shard CSVs
+are merged into the run's metadata CSV.
+
+The queue is also the lock that serialises claims and key assignment, so new AnonIDs
+stay unique across workers. A worker refreshes a heartbeat on its running shard; a shard
+whose heartbeat is older than `stale_after` (its worker died) is claimed again by the
+next worker, while shards of live workers are never taken over. Studies added to the
+source directory after the queue was filled (re-exports, top-ups) are queued in new
+shards the next time a worker prepares the run.
+
+All workers must see the same files: on one machine this is a local disk; across machines
+it needs a shared file system with working SQLite (POSIX) locks, which many SMB/NFS
+mounts do not provide.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import pandas as pd
+
+from anon_keys import KeyRegistry
+from anonymise_dicoms import MetadataExtraction, Anonymisation
+from dicom_index import DicomIndex
+from run_metrics import RunMetrics
+
+
+def default_queue_path(anon_dir: str) -> str:
+    """Returns the work queue path used for `anon_dir`: `<anon_dir>_shards.sqlite` next to it."""
+    return os.path.normpath(anon_dir) + '_shards.sqlite'
+
+
+def shard_of(study: str, n_shards: int) -> int:
+    """Returns the shard of a study: a stable hash of its name (unlike `hash()`, the same in every process)."""
+    digest = hashlib.blake2b(study.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n_shards
+
+
+class StudyQueue:
+    """
+    SQLite work queue of study shards, shared by all the workers of a run.
+
+    Connections are opened per operation, so the queue can be passed to worker processes.
+
+    Args:
+        queue_path (str): SQLite file of the queue.
+        timeout (float): Seconds to wait for the lock held by another worker.
+        heartbeat_interval (float): Seconds between heartbeats of a running shard.
+        stale_after (float): Seconds without a heartbeat after which a running shard is taken to be
+            abandoned (its worker died) and may be claimed again. Keep it well above `heartbeat_interval`
+            and the clock differences between machines.
+    """
+
+    def __init__(self, queue_path: str, timeout: float = 600, heartbeat_interval: float = 60,
+                 stale_after: float = 900):
+        self.queue_path = queue_path
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+
+    @contextmanager
+    def lock(self):
+        """Holds the queue's write lock (across processes) for the block, yielding the connection."""
+        conn = sqlite3.connect(self.queue_path, timeout=self.timeout, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def create(self, studies: List[str], n_shards: int, retry: bool = False) -> int:
+        """
+        Fills the queue with the shards of `studies`. If another worker (or an earlier run) already has,
+        the existing shards are kept as they are and only the studies that are in none of them are
+        added, in new shards.
+
+        Args:
+            studies (List[str]): Study directory (or zip) names.
+            n_shards (int): Number of shards to split the studies (or the studies not queued yet) into.
+            retry (bool): Put shards that failed, or were abandoned by a worker that died (no heartbeat for
+                `stale_after`), back in the queue. Shards running in live workers are left alone.
+
+        Returns:
+            int: Number of shards in the queue.
+        """
+        with self.lock() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shards (
+                    shard INTEGER PRIMARY KEY,
+                    studies TEXT,
+                    status TEXT DEFAULT 'pending',
+                    worker TEXT,
+                    metadata_path TEXT,
+                    n_errors INTEGER,
+                    error TEXT,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    heartbeat REAL
+                )
+            """)
+            queued = set()
+            rows = conn.execute("SELECT studies FROM shards").fetchall()
+            for row in rows:
+                queued.update(json.loads(row[0]))
+            new_studies = sorted(set(studies) - queued)
+            if rows:
+                print(f"Using the existing queue {self.queue_path} ({len(rows)} shards, {len(queued)} studies)")
+                missing = queued - set(studies)
+                if missing:
+                    print(f"Warning: {len(missing)} queued studies are no longer in the source directory, "
+                          f"e.g. {sorted(missing)[0]}")
+            shards = {}
+            for study in new_studies:
+                shards.setdefault(shard_of(study, n_shards), []).append(study)
+            # Numbered after the existing shards, whose studies (and metadata CSVs) stay as they are
+            first = conn.execute("SELECT COALESCE(MAX(shard) + 1, 0) FROM shards").fetchone()[0] if rows else 0
+            conn.executemany("INSERT INTO shards (shard, studies) VALUES (?, ?)",
+                             [(first + shard, json.dumps(names)) for shard, names in sorted(shards.items())])
+            if rows and new_studies:
+                print(f"Queued {len(new_studies)} new studies in {len(shards)} new shards")
+            if retry:
+                conn.execute("UPDATE shards SET status = 'pending', worker = NULL WHERE status = 'failed' "
+                             "OR (status = 'running' AND heartbeat < ?)", (time.time() - self.stale_after,))
+            return conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+
+    def claim(self, worker: str):
+        """
+        Takes the next pending shard for `worker`, or else a running shard abandoned by a dead worker.
+
+        Returns:
+            Tuple: (shard, list of studies), or None when no shard is left.
+        """
+        now = time.time()
+        with self.lock() as conn:
+            row = conn.execute("SELECT shard, studies FROM shards WHERE status = 'pending' OR "
+                               "(status = 'running' AND heartbeat < ?) ORDER BY status = 'running', shard LIMIT 1",
+                               (now - self.stale_after,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE shards SET status = 'running', worker = ?, started_at = CURRENT_TIMESTAMP, "
+                         "heartbeat = ? WHERE shard = ?", (worker, now, row[0]))
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, shard: int, worker: str):
+        """Records that `worker` is still processing `shard`."""
+        with self.lock() as conn:
+            conn.execute("UPDATE shards SET heartbeat = ? WHERE shard = ? AND worker = ? AND status = 'running'",
+                         (time.time(), shard, worker))
+
+    @contextmanager
+    def keep_alive(self, shard: int, worker: str):
+        """Sends heartbeats for `shard` from a background thread while the block runs."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    self.heartbeat(shard, worker)
+                except sqlite3.Error as e:
+                    print(f"{worker}: heartbeat of shard {shard} failed: {e}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, shard: int, worker: str, metadata_path: str, n_errors: int):
+        with self.lock() as conn:
+            conn.execute("UPDATE shards SET status = 'done', metadata_path = ?, n_errors = ?, "
+                         "finished_at = CURRENT_TIMESTAMP WHERE shard = ? AND worker = ?",
+                         (metadata_path, n_errors, shard, worker))
+
+    def fail(self, shard: int, worker: str, error: str):
+        with self.lock() as conn:
+            conn.execute("UPDATE shards SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP "
+                         "WHERE shard = ? AND worker = ?", (error, shard, worker))
+
+    def status(self) -> pd.DataFrame:
+        """Returns one row per shard with its status, worker, errors and timestamps."""
+        conn = sqlite3.connect(self.queue_path, timeout=self.timeout)
+        try:
+            return pd.read_sql_query("SELECT shard, status, worker, n_errors, error, started_at, finished_at "
+                                     "FROM shards ORDER BY shard", conn)
+        finally:
+            conn.close()
+
+
+class ShardedRun:
+    """
+    The metadata -> keys -> anonymisation pipeline of `main.py`, run shard by shard from a `StudyQueue`.
+
+    Anonymisation is single-pass (`Anonymisation.copy_and_anonymise`), or zip-to-zip with `zipped_source`.
+
+    Args:
+        mrn_dir (str): Source directory of the studies.
+        anon_dir (str): Destination directory for the anonymised studies.
+        keys_path (str): Key CSV (see `anon_keys`).
+        metadata_path (str): Merged metadata CSV; per-shard CSVs are written next to it.
+        queue_path (str): Work queue shared by the workers, defaults to `<anon_dir>_shards.sqlite`.
+        zipped_source (bool): Studies are zips, anonymised zip-to-zip.
+        add_new_keys (bool): Give MRNs without a key a new AnonID.
+        io_threads (int): Concurrent header reads for metadata.
+        resume (bool): Keep a job manifest per shard, so re-run shards only redo new, changed or failed files
+            (or zips).
+        anonymiser_args (Dict): Keyword arguments of `Anonymisation` (e.g. hash_all_uids, uid_salt, uid_map_path).
+    """
+
+    def __init__(self, mrn_dir: str, anon_dir: str, keys_path: str, metadata_path: str, queue_path: str = None,
+                 zipped_source: bool = False, add_new_keys: bool = False, io_threads: int = 1, resume: bool = False,
+                 anonymiser_args: Dict = None):
+        self.mrn_dir = mrn_dir
+        self.anon_dir = anon_dir
+        self.keys_path = keys_path
+        self.metadata_path = metadata_path
+        self.queue = StudyQueue(queue_path or default_queue_path(anon_dir))
+        self.zipped_source = zipped_source
+        self.add_new_keys = add_new_keys
+        self.io_threads = io_threads
+        self.resume = resume
+        self.anonymiser_args = anonymiser_args or {}
+
+    def _list_studies(self) -> List[str]:
+        with os.scandir(self.mrn_dir) as entries:
+            if self.zipped_source:
+                return [os.path.splitext(e.name)[0] for e in entries if e.is_file() and e.name.lower().endswith('.zip')]
+            return [e.name for e in entries if e.is_dir()]
+
+    def prepare(self, n_shards: int, retry: bool = False) -> int:
+        """Fills the work queue with the cohort's shards (a no-op if another worker already has)."""
+        n_queued = self.queue.create(self._list_studies(), n_shards, retry=retry)
+        print(f"Work queue {self.queue.queue_path}: {n_queued} shards")
+        return n_queued
+
+    def shard_metadata_path(self, shard: int) -> str:
+        return f"{os.path.splitext(self.metadata_path)[0]}_shard{shard:04d}.csv"
+
+    def run_worker(self, worker: str = None) -> int:
+        """
+        Processes shards from the queue until none is left, then merges the metadata if all are done.
+
+        Args:
+            worker (str): Name recorded in the queue, defaults to `<hostname>-<pid>`.
+
+        Returns:
+            int: Number of shards this worker processed.
+        """
+        worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        metrics = RunMetrics()
+        registry = KeyRegistry(self.keys_path)  # Loaded once per worker
+        n_done = 0
+        while True:
+            claimed = self.queue.claim(worker)
+            if claimed is None:
+                break
+            shard, studies = claimed
+            print(f"{worker}: shard {shard} ({len(studies)} studies)")
+            try:
+                with self.queue.keep_alive(shard, worker):
+                    n_errors = self._process_shard(shard, studies, registry, metrics)
+            except Exception as e:
+                print(f"{worker}: shard {shard} failed: {e}")
+                self.queue.fail(shard, worker, str(e))
+                continue
+            self.queue.complete(shard, worker, self.shard_metadata_path(shard), n_errors)
+            n_done += 1
+
+        metrics.print_summary()
+        self.merge_metadata()
+        return n_done
+
+    def _process_shard(self, shard: int, studies: List[str], registry: KeyRegistry, metrics: RunMetrics) -> int:
+        """Runs metadata extraction, key assignment and anonymisation for one shard, returns its error count."""
+        # Only the shard's own study directories are scanned (zips all sit in the root)
+        index = DicomIndex(self.mrn_dir).scan(studies=[] if self.zipped_source else studies)
+        extractor = MetadataExtraction(self.mrn_dir, index=index, metrics=metrics)
+        valid_mrns = None if self.add_new_keys else registry.valid_mrns
+        if self.zipped_source:
+            metadata_df = extractor.extract_metadata_from_zips(valid_mrns, studies=studies)
+        else:
+            metadata_df = extractor.extract_metadata(valid_mrns, io_threads=self.io_threads, studies=studies)
+
+        if self.add_new_keys:
+            # Reloaded under the lock, so AnonIDs added by other workers are seen and not reused
+            with self.queue.lock():
+                registry = KeyRegistry(self.keys_path)
+                registry.add(metadata_df['mrn'])
+                registry.save()
+        metadata_df['AnonID'] = registry.map(metadata_df['mrn'])
+        metadata_df.to_csv(self.shard_metadata_path(shard), index=False)
+
+        anonymiser = Anonymisation(metrics=metrics, **self.anonymiser_args)
+        manifest_path = None
+        if self.resume:
+            manifest_path = os.path.normpath(self.anon_dir) + f'_manifest_shard{shard:04d}.sqlite'
+        if self.zipped_source:
+            summary_df = anonymiser.anonymise_zips(self.mrn_dir, self.anon_dir, metadata_df,
+                                                   manifest_path=manifest_path)
+        else:
+            summary_df = anonymiser.copy_and_anonymise(self.mrn_dir, self.anon_dir, metadata_df,
+                                                       manifest_path=manifest_path, index=index)
+        anonymiser.close()
+        errors_df = summary_df[summary_df['status'] == 'error']
+        if not errors_df.empty:
+            print(f"Shard {shard}: {len(errors_df)} files could not be anonymized:")
+            print(errors_df[['FilePath', 'error']].to_string(index=False))
+        return len(errors_df)
+
+    def merge_metadata(self) -> bool:
+        """
+        Merges the per-shard metadata CSVs into `metadata_path` once every shard is done.
+
+        Returns:
+            bool: Whether the metadata was merged.
+        """
+        with self.queue.lock() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall())
+            if not counts or set(counts) - {'done'}:
+                print(f"Metadata not merged yet, shards: {counts}")
+                return False
+            paths = [row[0] for row in conn.execute("SELECT metadata_path FROM shards ORDER BY shard")]
+            # Read as text so values are written back exactly as the shards wrote them
+            merged = pd.concat([pd.read_csv(path, dtype=str, keep_default_na=False) for path in paths],
+                               ignore_index=True)
+            part_path = self.metadata_path + '.part'
+            merged.to_csv(part_path, index=False)
+            os.replace(part_path, self.metadata_path)
+        print(f"Metadata of {len(paths)} shards merged into {self.metadata_path} ({len(merged)} studies)")
+        return True
+
+    def run_local(self, n_processes: int) -> pd.DataFrame:
+        """
+        Runs `n_processes` workers on this machine and waits for them.
+
+        Returns:
+            pd.DataFrame: Status of every shard (see `StudyQueue.status`).
+        """
+        if n_processes == 1:
+            self.run_worker()
+        else:
+            context = multiprocessing.get_context('spawn')
+            processes = [context.Process(target=self.run_worker, args=(f"{socket.gethostname()}-local{i}",))
+                         for i in range(n_processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        return self.queue.status()
@@ -0,0 +1,176 @@
+"""
+Anonymisation rules compiled into a lookup keyed by numeric DICOM tag.
+
+Rules are given per tag keyword as an action, or as an (action, value) tuple:
+- 'replace': set the element to `value`; '{AnonID}' in the value is filled in per study.
+- 'empty': keep the element but clear its value (sequences lose all their items).
+- 'remove': delete the element.
+- 'hash_uid': replace the UID with a deterministic, salted hash-based UID (see `uid_map`).
+
+With `hash_all_uids`, every UID element that identifies an instance (study, series, SOP
+instance, frame of reference, referenced instances...) is hashed as well, including those
+nested in reference sequences. UIDs that name a definition (SOP class, transfer syntax,
+coding scheme) and UIDs in private elements are left as they are.
+"""
+
+import hashlib
+import re
+import struct
+
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import DicomDictionary, tag_for_keyword
+from pydicom.sequence import Sequence
+from typing import Dict
+
+from uid_map import UIDMap
+
+ACTIONS = ('replace', 'empty', 'remove', 'hash_uid')
+
+DEFAULT_TAG_RULES = {
+    'PatientName': ('replace', '{AnonID}'),
+    'PatientID': ('replace', '{AnonID}'),
+    'PatientBirthDate': 'empty',
+    'PhysiciansOfRecord': 'empty',
+    'RequestingPhysician': 'empty',
+    'PerformingPhysicianName': 'empty',
+    'OperatorsName': 'empty',
+    'InstitutionAddress': 'empty',
+    'ReferringPhysicianName': 'empty',
+    'OtherPatientIDs': 'empty',
+    'ReferencedStudySequence': 'empty',
+    'StudyID': 'empty',
+    'PatientTelephoneNumbers': 'empty',
+    'InstitutionName': 'empty',
+}
+
+# Tags the DICOM dictionary defines as sequences, so the walk can find them without decoding values
+SEQUENCE_TAGS = frozenset(tag for tag, entry in DicomDictionary.items() if entry[0] == 'SQ')
+
+# UID elements that identify instances, hashed by `hash_all_uids`: all UI elements outside the file meta
+# group, except those naming a definition rather than an instance
+DEFINITION_UID_KEYWORDS = ('ClassUID', 'SOPClasses', 'TransferSyntaxUID', 'CodingSchemeUID', 'MappingResourceUID')
+UID_TAGS = frozenset(tag for tag, entry in DicomDictionary.items()
+                     if entry[0] == 'UI' and tag >> 16 != 0x0002
+                     and not any(part in entry[4] for part in DEFINITION_UID_KEYWORDS))
+
+SOP_INSTANCE_UID = 0x00080018
+MEDIA_STORAGE_SOP_INSTANCE_UID = 0x00020003
+
+
+class TagPlan:
+    """
+    Anonymisation rules compiled once per run.
+
+    Applying the plan only decodes elements whose tag is targeted, and only descends
+    into sequence elements, instead of decoding and keyword-matching every element.
+    Sequences that have not been decoded yet are skipped outright when their raw
+    bytes do not contain the encoding of any targeted tag.
+
+    Args:
+        rules (Dict): Action per tag keyword, defaults to `DEFAULT_TAG_RULES`.
+        uid_salt (str): Salt for the 'hash_uid' action (ignored if `uid_map` is given).
+        hash_all_uids (bool): Also hash every instance UID (see `UID_TAGS`); explicit rules take precedence.
+        uid_map (UIDMap): Memoised UID remapping to use, e.g. with a UID map on disk.
+
+    Raises:
+        ValueError: If a rule is invalid, or UIDs are hashed without a salt (anyone could then
+            recompute the hashes of known UIDs and link the outputs back to the originals).
+    """
+
+    def __init__(self, rules: Dict = None, uid_salt: str = '', hash_all_uids: bool = False, uid_map: UIDMap = None):
+        self.uid_map = uid_map if uid_map is not None else UIDMap(uid_salt)
+        self.uid_salt = self.uid_map.salt
+        self.actions = {}
+        for keyword, rule in (DEFAULT_TAG_RULES if rules is None else rules).items():
+            action, value = (rule, None) if isinstance(rule, str) else rule
+            if action not in ACTIONS:
+                raise ValueError(f"Invalid action for {keyword}: {action}")
+            tag = tag_for_keyword(keyword)
+            if tag is None:
+                raise ValueError(f"Unknown DICOM keyword: {keyword}")
+            self.actions[tag] = (action, value)
+        if hash_all_uids:
+            for tag in UID_TAGS:
+                self.actions.setdefault(tag, ('hash_uid', None))
+        if not self.uid_salt and any(action == 'hash_uid' for action, _ in self.actions.values()):
+            raise ValueError("Hashing UIDs requires a secret uid_salt")
+        self.tags = frozenset(self.actions)
+        # Identifies the rules and salt, e.g. to tell whether an earlier output was written with the same plan
+        self.fingerprint = hashlib.blake2b(repr((sorted(self.actions.items()), self.uid_salt)).encode('utf-8'),
+                                           digest_size=8).hexdigest()
+        # The file meta copy of the SOP instance UID must match the hashed one
+        self._hash_media_storage_uid = self.actions.get(SOP_INSTANCE_UID, (None,))[0] == 'hash_uid'
+        # Encoded tag bytes in either byte order, to rule out raw sequences without decoding them
+        patterns = {struct.pack(fmt, tag >> 16, tag & 0xFFFF) for tag in self.tags for fmt in ('<HH', '>HH')}
+        self._pattern = re.compile(b'|'.join(re.escape(pattern) for pattern in sorted(patterns)))
+        self._anon_id = None
+        self._values = {}
+
+    def _resolve_values(self, anon_id: str) -> Dict:
+        """Fills in '{AnonID}' in the replacement values, once per study."""
+        if anon_id != self._anon_id or not self._values:
+            self._anon_id = anon_id
+            self._values = {
+                tag: value.format(AnonID=anon_id) if isinstance(value, str) else value
+                for tag, (action, value) in self.actions.items() if action == 'replace'
+            }
+        return self._values
+
+    def _is_sequence(self, dataset, tag) -> bool:
+        """Checks whether an element is a sequence, decoding it only for private/unknown tags."""
+        if tag in SEQUENCE_TAGS:
+            return True
+        if tag >> 16 & 1:  # Private tags are not in the dictionary
+            vr = dataset.get_item(tag, keep_deferred=True).VR
+            if vr in (None, 'UN'):
+                vr = dataset[tag].VR
+            return vr == 'SQ'
+        return False
+
+    def apply(self, dataset, anon_id: str):
+        """
+        Applies the plan to a DICOM dataset, including nested sequences.
+
+        Args:
+            dataset (pydicom.dataset.Dataset): The DICOM dataset to anonymize.
+            anon_id (str): AnonID of the study the dataset belongs to.
+        """
+        self._apply(dataset, self._resolve_values(str(anon_id)))
+        file_meta = getattr(dataset, 'file_meta', None)
+        if self._hash_media_storage_uid and file_meta is not None and MEDIA_STORAGE_SOP_INSTANCE_UID in file_meta:
+            elem = file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID]
+            elem.value = self.uid_map.remap(elem.value)
+
+    def may_target(self, data: bytes) -> bool:
+        """Checks whether raw DICOM bytes may contain a targeted tag (at any nesting depth)."""
+        return bool(self.tags) and self._pattern.search(data) is not None
+
+    def _may_contain_target(self, dataset, tag) -> bool:
+        """Checks whether a sequence can contain a targeted tag."""
+        raw = dataset.get_item(tag)
+        if isinstance(raw, RawDataElement) and isinstance(raw.value, bytes):
+            return self._pattern.search(raw.value) is not None
+        return True
+
+    def _apply(self, dataset, values: Dict):
+        hits = self.tags.intersection(dataset.keys())
+        for tag in [t for t in dataset.keys() if t not in hits and self._is_sequence(dataset, t)]:
+            if not self._may_contain_target(dataset, tag):
+                continue
+            for item in dataset[tag].value:
+                self._apply(item, values)
+
+        for tag in hits:
+            action = self.actions[tag][0]
+            if action == 'remove':
+                del dataset[tag]
+                continue
+            elem = dataset[tag]
+            if action == 'replace':
+                elem.value = values[tag]
+            elif action == 'empty':
+                elem.value = Sequence() if elem.VR == 'SQ' else ''
+            elif elem.VM > 1:
+                elem.value = [self.uid_map.remap(uid) for uid in elem.value]
+            elif elem.value:
+                elem.value = self.uid_map.remap(elem.value)
@@ -0,0 +1,139 @@
+"""
+Memoised UID remapping: each original UID maps to one deterministic, salted hash-based UID.
+
+The same UID gets the same replacement in every file, process and run that uses the
+same salt, so references between files (series, frames of reference, referenced
+instances) still line up after anonymisation. Recently used UIDs are kept in a bounded
+LRU cache, so the study, series and frame-of-reference UIDs repeated in every file are
+hashed once. New mappings are written in batches to an optional SQLite UID map on disk,
+which keeps the original -> anonymised UIDs of a project across runs (like the key CSV,
+it re-identifies the data and must be kept as safe). The map records a fingerprint of
+the salt and refuses to be used with another one, so a re-run cannot silently produce
+different UIDs.
+
+A UID evicted from the cache is hashed again rather than read back from disk: the
+hash costs about as much as a SQLite lookup (a few microseconds) and gives the same result.
+
+UIDs under the DICOM root (1.2.840.10008) name standard definitions (SOP classes,
+transfer syntaxes, well-known frames of reference), not instances, and are never changed.
+"""
+
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+from pydicom.uid import PYDICOM_ROOT_UID
+
+DICOM_ROOT_UID = '1.2.840.10008.'
+
+
+def hash_uid(uid: str, salt: str = '', prefix: str = PYDICOM_ROOT_UID) -> str:
+    """
+    Returns a deterministic UID derived from the salted SHA-512 hash of `uid`.
+
+    Same UID as `pydicom.uid.generate_uid(prefix, entropy_srcs=[salt, uid])`, as a plain string and
+    without its per-call prefix validation, which together are most of its cost.
+    """
+    digest = hashlib.sha512(f"{salt}{uid}".encode('utf-8')).digest()
+    return f"{prefix}{int.from_bytes(digest, 'big')}"[:64]
+
+
+def _salt_fingerprint(salt: str) -> str:
+    """Fingerprint stored in the UID map to check the salt, without storing the salt itself."""
+    return hashlib.blake2b(salt.encode('utf-8'), digest_size=16, person=b'uid_map').hexdigest()
+
+
+# One UIDMap per process and settings, so worker processes keep their cache between batches
+_process_maps = {}
+
+
+def _process_uid_map(salt: str, store_path: str, cache_size: int, flush_size: int) -> 'UIDMap':
+    key = (salt, store_path, cache_size, flush_size)
+    if key not in _process_maps:
+        _process_maps[key] = UIDMap(salt, store_path, cache_size, flush_size)
+    return _process_maps[key]
+
+
+class UIDMap:
+    """
+    Original -> anonymised UIDs with a bounded LRU cache and an optional SQLite map on disk.
+
+    Pickling a UIDMap (e.g. with the `Anonymisation` sent to worker processes) only carries
+    its settings; each process unpickles them into one shared instance with its own cache.
+
+    Args:
+        salt (str): Secret salt of the hash; keep it the same for every run of a project.
+        store_path (str): SQLite UID map to write new mappings to, created if needed.
+        cache_size (int): Maximum number of UIDs kept in memory.
+        flush_size (int): Number of new mappings written to `store_path` at once.
+
+    Raises:
+        ValueError: If `store_path` was created with another salt.
+    """
+
+    def __init__(self, salt: str = '', store_path: str = None, cache_size: int = 200_000,
+                 flush_size: int = 10_000):
+        self.salt = salt
+        self.store_path = store_path
+        self.cache_size = cache_size
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._pending = []
+        self._conn = self._open_store() if store_path else None
+
+    def __reduce__(self):
+        return _process_uid_map, (self.salt, self.store_path, self.cache_size, self.flush_size)
+
+    def _open_store(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.store_path, timeout=60)
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS uids (original TEXT PRIMARY KEY, anonymised TEXT) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO settings VALUES ('salt_fingerprint', ?)",
+                         (_salt_fingerprint(self.salt),))
+        stored, = conn.execute("SELECT value FROM settings WHERE name = 'salt_fingerprint'").fetchone()
+        if stored != _salt_fingerprint(self.salt):
+            conn.close()
+            raise ValueError(f"UID map {self.store_path} was created with a different uid_salt")
+        return conn
+
+    def __len__(self):
+        return len(self._cache)
+
+    def remap(self, uid: str) -> str:
+        """Returns the anonymised UID of `uid` (standard DICOM UIDs are returned unchanged)."""
+        uid = str(uid)
+        anonymised = self._cache.get(uid)
+        if anonymised is not None:
+            self._cache.move_to_end(uid)
+            self.hits += 1
+            return anonymised
+        if uid.startswith(DICOM_ROOT_UID):
+            return uid
+
+        self.misses += 1
+        anonymised = hash_uid(uid, self.salt)
+        self._cache[uid] = anonymised
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        if self._conn is not None:
+            self._pending.append((uid, anonymised))
+            if len(self._pending) >= self.flush_size:
+                self.flush()
+        return anonymised
+
+    def flush(self):
+        """Writes the mappings added since the last flush to the UID map on disk."""
+        if self._conn is None or not self._pending:
+            return
+        with self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO uids VALUES (?, ?)", self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,259 @@
+"""
+Parallel bulk zipping and unzipping of study folders, replacing `zip_bulk.ps1` and `unzip_bulk.ps1`.
+
+Each archive is zipped or unzipped by its own worker process, so a folder of studies uses
+all cores instead of one, on Windows and Linux alike. Zipping picks the compression of
+each member: DICOM files whose pixel data is already compressed (JPEG, JPEG 2000, RLE,
+deflated transfer syntaxes) and other already compressed formats are stored as they are,
+as deflating them again costs CPU time for no gain; uncompressed DICOM files are deflated.
+For other files, a sample of the file is deflated to decide. Archives are written under a
+`.part` name and only renamed once complete, so an existing zip is always a complete one
+and re-runs skip it.
+
+As with `Compress-Archive`, each zip holds one top-level folder named after the study
+folder; each archive is unzipped into a folder named after it (as `ZipFolderHandler` did).
+
+Usage:
+    python zip_bulk.py zip <studies folder> <zips folder> [--workers 8] [--level 6] [--overwrite]
+    python zip_bulk.py unzip <zips folder> <studies folder> [--workers 8]
+"""
+
+import argparse
+import os
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List
+
+import pandas as pd
+from pydicom.filereader import read_file_meta_info
+from pydicom.uid import UID
+
+from run_metrics import Progress, RunMetrics
+
+# Formats that are compressed already and are stored without deflating
+COMPRESSED_EXTENSIONS = ('.zip', '.gz', '.bz2', '.xz', '.7z', '.jpg', '.jpeg', '.png', '.gif', '.j2k', '.jp2',
+                         '.mp4', '.avi', '.mov', '.pdf')
+# Deflate a member only if a sample of it shrinks to less than this fraction of its size
+MIN_RATIO = 0.9
+SAMPLE_SIZE = 1 << 16
+
+RESULT_COLUMNS = ['source', 'output', 'status', 'error', 'files', 'bytes', 'stored', 'deflated', 'seconds']
+
+
+def transfer_syntax_compression(transfer_syntax) -> int:
+    """
+    Returns `zipfile.ZIP_STORED` for a compressed (encapsulated or deflated) transfer syntax,
+    `zipfile.ZIP_DEFLATED` for an uncompressed one, or None if it is not a known transfer syntax.
+    """
+    if not transfer_syntax:
+        return None
+    uid = UID(str(transfer_syntax))
+    try:
+        # Deflated Explicit VR Little Endian is not `is_compressed`, but deflating it again gains nothing either
+        return zipfile.ZIP_STORED if uid.is_compressed or uid.is_deflated else zipfile.ZIP_DEFLATED
+    except ValueError:
+        return None
+
+
+def sample_compression(sample: bytes) -> int:
+    """Returns `zipfile.ZIP_DEFLATED` if a fast deflate of `sample` saves enough, else `zipfile.ZIP_STORED`."""
+    sample = sample[:SAMPLE_SIZE]
+    if not sample or len(zlib.compress(sample, 1)) < MIN_RATIO * len(sample):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+def file_compression(path: str) -> int:
+    """
+    Returns the compression to zip the file at `path` with: by extension for compressed formats,
+    by transfer syntax for DICOM files (only the file meta information is read), else by a sample.
+    """
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if sample[128:132] == b'DICM':
+        try:
+            compress_type = transfer_syntax_compression(read_file_meta_info(path).get('TransferSyntaxUID'))
+        except Exception:
+            compress_type = None  # Damaged file meta, decide by the sample
+        if compress_type is not None:
+            return compress_type
+    return sample_compression(sample)
+
+
+def zip_folder(folder: str, zip_path: str, compresslevel: int = 6, overwrite: bool = False) -> Dict:
+    """
+    Zips `folder` into `zip_path`, under a top-level folder of the same name, choosing the
+    compression of each member with `file_compression`.
+
+    Args:
+        folder (str): Study folder to zip.
+        zip_path (str): Path of the zip to write.
+        compresslevel (int): Deflate level (1 = fastest, 9 = smallest).
+        overwrite (bool): Zip again if `zip_path` exists (otherwise it is skipped).
+
+    Returns:
+        Dict: source, output, status ('zipped', 'skipped' or 'error'), error, files, bytes,
+            stored and deflated member counts and seconds.
+    """
+    result = dict.fromkeys(RESULT_COLUMNS, 0)
+    result.update(source=folder, output=zip_path, status='zipped', error='')
+    if os.path.exists(zip_path) and not overwrite:
+        result['status'] = 'skipped'
+        return result
+
+    start = time.perf_counter()
+    root = os.path.basename(os.path.normpath(folder))
+    part_path = zip_path + '.part'
+    try:
+        os.makedirs(os.path.dirname(zip_path) or '.', exist_ok=True)
+        with zipfile.ZipFile(part_path, 'w', allowZip64=True) as zf:
+            for dirpath, dirnames, filenames in os.walk(folder):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    arcname = os.path.join(root, os.path.relpath(path, folder)).replace(os.sep, '/')
+                    compress_type = file_compression(path)
+                    # Members are streamed from disk in chunks, large files never have to fit in memory
+                    zf.write(path, arcname, compress_type=compress_type,
+                             compresslevel=compresslevel if compress_type == zipfile.ZIP_DEFLATED else None)
+                    result['files'] += 1
+                    result['bytes'] += os.path.getsize(path)
+                    result['stored' if compress_type == zipfile.ZIP_STORED else 'deflated'] += 1
+        os.replace(part_path, zip_path)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def unzip_archive(zip_path: str, destination_folder: str) -> Dict:
+    """
+    Extracts `zip_path` into `destination_folder`, created if needed.
+
+    Returns:
+        Dict: source, output, status ('unzipped' or 'error'), error, files, bytes and seconds.
+    """
+    result = dict.fromkeys(RESULT_COLUMNS, 0)
+    result.update(source=zip_path, output=destination_folder, status='unzipped', error='')
+    start = time.perf_counter()
+    try:
+        os.makedirs(destination_folder, exist_ok=True)
+        with zipfile.ZipFile(zip_path) as zf:
+            members = [info for info in zf.infolist() if not info.is_dir()]
+            zf.extractall(destination_folder)
+        result['files'] = len(members)
+        result['bytes'] = sum(info.file_size for info in members)
+        result['stored'] = sum(info.compress_type == zipfile.ZIP_STORED for info in members)
+        result['deflated'] = len(members) - result['stored']
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _run_archives(func: Callable, jobs: List, n_workers: int, stage_name: str, metrics: RunMetrics) -> pd.DataFrame:
+    """Runs `func(*job)` for every job, in a pool of `n_workers` processes unless it is 1, and collects the results."""
+    metrics = metrics or RunMetrics()
+    results = []
+    with metrics.run_stage(stage_name) as stage:
+        progress = Progress(stage_name, len(jobs), unit='zips')
+
+        def collect(result):
+            results.append(result)
+            stage.timers['write'] += result['seconds']  # Reading, (de)compressing and writing are interleaved
+            stage.count(files=result['files'], bytes=result['bytes'], skipped=int(result['status'] == 'skipped'),
+                        errors=int(result['status'] == 'error'))
+            progress.update(1, result['bytes'])
+
+        if n_workers == 1:
+            for job in jobs:
+                collect(func(*job))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(func, *job): job for job in jobs}
+                for future in as_completed(futures):
+                    try:
+                        collect(future.result())
+                    except Exception as e:
+                        # The worker itself failed (e.g. crashed)
+                        collect({**dict.fromkeys(RESULT_COLUMNS, 0), 'source': futures[future][0],
+                                 'output': futures[future][1], 'status': 'error', 'error': str(e)})
+
+    summary = pd.DataFrame(results, columns=RESULT_COLUMNS).sort_values('source', ignore_index=True)
+    errors = summary[summary['status'] == 'error']
+    for _, row in errors.iterrows():
+        print(f"Error in {row['source']}: {row['error']}")
+    return summary
+
+
+def zip_folders(source_dir: str, destination_dir: str, n_workers: int = None, compresslevel: int = 6,
+                overwrite: bool = False, metrics: RunMetrics = None) -> pd.DataFrame:
+    """
+    Zips every folder in `source_dir` into `<destination_dir>/<folder>.zip`, one archive per worker process.
+
+    Args:
+        source_dir (str): Folder of the study folders.
+        destination_dir (str): Folder of the zips, created if needed.
+        n_workers (int): Number of worker processes (1 = run in this process, None = all CPUs).
+        compresslevel (int): Deflate level of the deflated members.
+        overwrite (bool): Zip again folders whose zip exists already.
+        metrics (RunMetrics): Run metrics to record the 'zip' stage in.
+
+    Returns:
+        pd.DataFrame: One row per folder (source, output, status, error, files, bytes, stored, deflated, seconds).
+    """
+    os.makedirs(destination_dir, exist_ok=True)
+    jobs = [(os.path.join(source_dir, name), os.path.join(destination_dir, f"{name}.zip"), compresslevel, overwrite)
+            for name in sorted(os.listdir(source_dir)) if os.path.isdir(os.path.join(source_dir, name))]
+    return _run_archives(zip_folder, jobs, n_workers, 'zip', metrics)
+
+
+def unzip_archives(source_dir: str, destination_dir: str, n_workers: int = None,
+                   metrics: RunMetrics = None) -> pd.DataFrame:
+    """
+    Extracts every zip in `source_dir` into `<destination_dir>/<zip name>`, one archive per worker process.
+
+    Args:
+        source_dir (str): Folder of the zips.
+        destination_dir (str): Folder to extract them into.
+        n_workers (int): Number of worker processes (1 = run in this process, None = all CPUs).
+        metrics (RunMetrics): Run metrics to record the 'unzip' stage in.
+
+    Returns:
+        pd.DataFrame: One row per zip (source, output, status, error, files, bytes, stored, deflated, seconds).
+    """
+    jobs = [(os.path.join(source_dir, name), os.path.join(destination_dir, os.path.splitext(name)[0]))
+            for name in sorted(os.listdir(source_dir)) if zipfile.is_zipfile(os.path.join(source_dir, name))]
+    return _run_archives(unzip_archive, jobs, n_workers, 'unzip', metrics)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    zip_parser = commands.add_parser('zip', help="Zip every folder of a directory")
+    zip_parser.add_argument('source_dir', help="Folder of the study folders")
+    zip_parser.add_argument('destination_dir', help="Folder to write the zips to")
+    zip_parser.add_argument('--level', type=int, default=6, help="Deflate level, 1 (fastest) to 9 (smallest)")
+    zip_parser.add_argument('--overwrite', action='store_true', help="Zip again folders whose zip exists")
+    unzip_parser = commands.add_parser('unzip', help="Unzip every zip of a directory")
+    unzip_parser.add_argument('source_dir', help="Folder of the zips")
+    unzip_parser.add_argument('destination_dir', help="Folder to extract them into")
+    for command_parser in (zip_parser, unzip_parser):
+        command_parser.add_argument('--workers', type=int, default=None,
+                                    help="Number of worker processes (default: all CPUs)")
+    args = parser.parse_args()
+
+    run_metrics = RunMetrics()
+    if args.command == 'zip':
+        zip_folders(args.source_dir, args.destination_dir, args.workers, args.level, args.overwrite, run_metrics)
+    else:
+        unzip_archives(args.source_dir, args.destination_dir, args.workers, run_metrics)
+    run_metrics.print_summary()